@@ -1,39 +1,777 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Query, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from pymongo import DeleteMany, DeleteOne, ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import sys
+import copy
+import queue
 import logging
+import logging.handlers
+import threading
+import weakref
 from pathlib import Path
+from urllib.parse import parse_qsl
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import uuid
-from datetime import datetime
+import asyncio
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 import base64
+import json
+import re
 import hashlib
+import hmac
+import gzip
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 import httpx
 
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
+from storage import Storage, MotorStorage, MemoryStorage
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
 
-# Create the main app
-app = FastAPI(title="Shooting Range API")
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+# Logging pipeline, records are written by a background thread
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# Past this share of the queue only warnings and errors are accepted
+LOG_QUEUE_SOFT_LIMIT = float(os.environ.get('LOG_QUEUE_SOFT_LIMIT', '0.8'))
+
+# Discount card settings
+CARD_CACHE_SIZE = int(os.environ.get('CARD_CACHE_SIZE', '10000'))
+CARD_CACHE_TTL_SECONDS = float(os.environ.get('CARD_CACHE_TTL_SECONDS', '60'))
+CARD_SIGNING_SECRET = os.environ.get('CARD_SIGNING_SECRET', '')
+SIGNED_CARD_PREFIX = "SR1"
+
+# Read coalescing settings (0 disables the micro-cache, in-flight sharing is always on)
+COALESCE_CACHE_SECONDS = float(os.environ.get('COALESCE_CACHE_SECONDS', '0'))
+
+# Cart lifecycle settings (CART_TTL_DAYS=0 disables expiry of abandoned carts)
+CART_TTL_DAYS = float(os.environ.get('CART_TTL_DAYS', '30'))
+CART_EXPIRY_WARNING_HOURS = float(os.environ.get('CART_EXPIRY_WARNING_HOURS', '24'))
+CART_EMPTY_GRACE_MINUTES = float(os.environ.get('CART_EMPTY_GRACE_MINUTES', '60'))
+CART_COMPACTION_INTERVAL_SECONDS = float(os.environ.get('CART_COMPACTION_INTERVAL_SECONDS', '3600'))
+
+# Referential integrity checker settings
+INTEGRITY_CHECK_INTERVAL_SECONDS = float(os.environ.get('INTEGRITY_CHECK_INTERVAL_SECONDS', '21600'))
+INTEGRITY_AUTO_REPAIR = os.environ.get('INTEGRITY_AUTO_REPAIR', 'true').lower() == 'true'
+
+# User stats reconciliation settings
+USER_STATS_RECONCILE_INTERVAL_SECONDS = float(os.environ.get('USER_STATS_RECONCILE_INTERVAL_SECONDS', '86400'))
+USER_STATS_RECONCILE_CHUNK_SIZE = int(os.environ.get('USER_STATS_RECONCILE_CHUNK_SIZE', '1000'))
+
+# Profile summary settings
+PROFILE_RECENT_ORDERS = int(os.environ.get('PROFILE_RECENT_ORDERS', '5'))
+LOYALTY_RULES_CACHE_SECONDS = float(os.environ.get('LOYALTY_RULES_CACHE_SECONDS', '60'))
+
+# Idempotent order submission
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '10'))
+
+# One-off data migrations, a lock older than this is considered abandoned
+MIGRATION_LOCK_SECONDS = float(os.environ.get('MIGRATION_LOCK_SECONDS', '600'))
+
+# Response compression settings
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_OFFLOAD_SIZE = int(os.environ.get('COMPRESSION_OFFLOAD_SIZE', '65536'))
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', '256'))
+# Local writes drop cached listings at once, this bounds staleness from other instances
+COMPRESSION_CACHE_SECONDS = float(os.environ.get('COMPRESSION_CACHE_SECONDS', '30'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+# Request profiling, off unless a token or a slow-request threshold is configured
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', '0'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+PROFILE_BUFFER_SIZE = int(os.environ.get('PROFILE_BUFFER_SIZE', '50'))
+
+# ===================== LOGGING =====================
+
+# (request id, perf_counter at request start) of the request being served
+current_request: ContextVar[tuple] = ContextVar("current_request", default=("-", None))
+
+STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, extra= fields are emitted as top-level keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller, low-priority records are dropped when the queue backs up
+
+    Records below keep_level are dropped once the queue passes its soft limit, so the
+    remaining room is left for warnings and errors. Debug records are formatted by the
+    listener thread, callers pass their arguments instead of pre-formatting them.
+    """
+
+    def __init__(self, log_queue: queue.Queue, soft_limit: int, keep_level: int = logging.WARNING):
+        super().__init__(log_queue)
+        self.soft_limit = soft_limit
+        self.keep_level = keep_level
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        request_id, started = current_request.get()
+        record.request_id = request_id
+        if started is not None:
+            record.elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        if record.levelno > logging.DEBUG:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        backed_up = self.queue.qsize() >= self.soft_limit
+        if backed_up and record.levelno < self.keep_level:
+            self._drop()
+            return
+        try:
+            if self._unreported and not backed_up:
+                self.queue.put_nowait(self._drop_report())
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+    def _drop(self):
+        self.dropped += 1
+        self._unreported += 1
+
+    def _drop_report(self) -> logging.LogRecord:
+        report = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "Dropped %d log records while the logging queue was backed up", (self._unreported,), None
+        )
+        report.dropped = self._unreported
+        self._unreported = 0
+        return self.prepare(report)
+
+class LogPipeline:
+    """Process-wide queue logging, installed by the first app that starts and removed by the last
+
+    Like logging.basicConfig it stays out of the way when the root logger already has
+    handlers, such as a host-provided config or pytest's log capture.
+    """
+
+    def __init__(self):
+        self.handler: Optional[DroppingQueueHandler] = None
+        self._listener = None
+        self._users = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._users += 1
+            root = logging.getLogger()
+            if self.handler is not None or root.handlers:
+                return
+            log_queue = queue.Queue(LOG_QUEUE_SIZE)
+            self.handler = DroppingQueueHandler(log_queue, int(LOG_QUEUE_SIZE * LOG_QUEUE_SOFT_LIMIT))
+            output = logging.StreamHandler()
+            output.setFormatter(JsonFormatter())
+            self._listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+            root.addHandler(self.handler)
+            root.setLevel(LOG_LEVEL)
+            self._listener.start()
+
+    def stop(self):
+        with self._lock:
+            self._users = max(self._users - 1, 0)
+            if self._users or self.handler is None:
+                return
+            logging.getLogger().removeHandler(self.handler)
+            # Flushes what is still queued
+            self._listener.stop()
+            self.handler = None
+            self._listener = None
+
+log_pipeline = LogPipeline()
+
+async def start_logging():
+    log_pipeline.start()
+
+async def stop_logging():
+    log_pipeline.stop()
+
+class RequestLogMiddleware:
+    """Assigns each request an id, echoed as X-Request-ID, and logs its timing when done"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = Headers(scope=scope).get("x-request-id", "")
+        if not request_id or len(request_id) > 128:
+            request_id = uuid.uuid4().hex
+        started = time.perf_counter()
+        status = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
+
+        token = current_request.set((request_id, started))
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            logger.info(
+                "%s %s %s %sms", scope["method"], scope["path"], status.get("code"), duration_ms,
+                extra={"method": scope["method"], "path": scope["path"], "status": status.get("code"),
+                       "duration_ms": duration_ms}
+            )
+            current_request.reset(token)
+
+# ===================== CACHING =====================
+
+class LRUCache:
+    """Small in-process LRU cache with per-entry expiry"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """Coalesce concurrent identical reads into one query and one serialized body"""
+
+    def __init__(self, cache_seconds: float = 0):
+        self.cache_seconds = cache_seconds
+        self._inflight = {}
+        self._cache = {}
+        # Bumped by invalidate(), loads started before a write must not be cached
+        self._generation = 0
+        self.stats = {"requests": 0, "executions": 0, "coalesced": 0, "cache_hits": 0, "errors": 0}
+
+    async def do(self, key, loader) -> bytes:
+        self.stats["requests"] += 1
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires_at, body = cached
+            if expires_at >= time.monotonic():
+                self.stats["cache_hits"] += 1
+                return body
+            del self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["executions"] += 1
+            task = asyncio.ensure_future(self._run(key, loader))
+            self._inflight[key] = task
+            generation = self._generation
+            task.add_done_callback(lambda t: self._finish(key, t, generation))
+        # Shield so one disconnecting client does not cancel the shared query
+        return await asyncio.shield(task)
+
+    async def _run(self, key, loader) -> bytes:
+        result = await loader()
+        return JSONResponse(content=jsonable_encoder(result)).body
+
+    def _finish(self, key, task, generation: int):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.stats["errors"] += 1
+            return
+        if self.cache_seconds > 0 and generation == self._generation:
+            self._cache[key] = (time.monotonic() + self.cache_seconds, task.result())
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def invalidate(self):
+        self._generation += 1
+        self._cache.clear()
+        # Requests after the write start a fresh load instead of joining a stale one
+        self._inflight.clear()
+
+async def coalesced_response(key, loader) -> Response:
+    body = await read_coalescer.do(key, loader)
+    return Response(content=body, media_type="application/json")
+
+# ===================== APP STATE =====================
+
+class AppConfig(BaseModel):
+    storage: str = "motor"  # motor / memory
+    mongo_url: str = ""
+    db_name: str = ""
+    background_jobs: bool = True
+
+    @classmethod
+    def from_env(cls) -> "AppConfig":
+        return cls(
+            storage=os.environ.get('STORAGE_BACKEND', 'motor'),
+            mongo_url=os.environ.get('MONGO_URL', ''),
+            db_name=os.environ.get('DB_NAME', ''),
+            background_jobs=os.environ.get('BACKGROUND_JOBS', 'true').lower() == 'true',
+        )
+
+class AppState:
+    """Everything one app instance owns, so several instances can share a process"""
+
+    def __init__(self, config: AppConfig, storage: Optional[Storage] = None):
+        self.config = config
+        self.storage = storage
+        self.card_cache = LRUCache(CARD_CACHE_SIZE, CARD_CACHE_TTL_SECONDS)
+        self.read_coalescer = SingleFlight(COALESCE_CACHE_SECONDS)
+        self.loyalty_rules_cache = LRUCache(1, LOYALTY_RULES_CACHE_SECONDS)
+        self.background_tasks = set()
+        self.order_submissions = {}
+        self.profiler = RequestProfiler(PROFILE_SAMPLE_INTERVAL_MS, PROFILE_BUFFER_SIZE)
+
+current_app_state: ContextVar[AppState] = ContextVar("current_app_state")
+
+class AppStateProxy:
+    """Resolves to an attribute of the app instance serving the current request"""
+
+    def __init__(self, attr: str):
+        self._attr = attr
+
+    def __getattr__(self, name):
+        return getattr(getattr(current_app_state.get(), self._attr), name)
+
+db = AppStateProxy("storage")
+card_cache = AppStateProxy("card_cache")
+read_coalescer = AppStateProxy("read_coalescer")
+loyalty_rules_cache = AppStateProxy("loyalty_rules_cache")
+
+class AppStateMiddleware:
+    """Binds the app state for each request, background tasks spawned by it inherit it"""
+
+    def __init__(self, app, state: AppState):
+        self.app = app
+        self.state = state
+
+    async def __call__(self, scope, receive, send):
+        token = current_app_state.set(self.state)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_app_state.reset(token)
+
+def build_storage(config: AppConfig) -> Storage:
+    if config.storage == "memory":
+        return MemoryStorage()
+    if config.storage == "motor":
+        if not config.mongo_url or not config.db_name:
+            raise RuntimeError("MONGO_URL and DB_NAME are required for the motor storage backend")
+        return MotorStorage(config.mongo_url, config.db_name)
+    raise RuntimeError(f"Unknown storage backend: {config.storage}")
+
+# ===================== COMPRESSION =====================
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+# Slow-changing listings whose compressed bodies are cached and served with an ETag,
+# with the query parameters each one reads (others must not create cache entries)
+PRECOMPRESSED_PATHS = {
+    "/api/catalogs": ("visible_only", "is_product"),
+    "/api/products": ("catalog_id", "visible_only"),
+    "/api/services": ("catalog_id", "visible_only"),
+    "/api/loyalty-rules": (),
+}
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0
+        if name:
+            accepted[name.strip().lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """gzip/brotli response compression with a cache of listing responses
+
+    Listings in PRECOMPRESSED_PATHS are cached per path and known parameters and served,
+    including ETag revalidation, without running the handler. Entries are dropped by
+    the same writes that invalidate the read coalescer. Bodies above offload_size are
+    compressed in the thread pool so large image-heavy listings do not block the loop.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, offload_size: int = COMPRESSION_OFFLOAD_SIZE,
+                 cache_size: int = COMPRESSION_CACHE_SIZE, cache_seconds: float = COMPRESSION_CACHE_SECONDS):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.cache = LRUCache(cache_size, ttl=cache_seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        cacheable = scope["method"] == "GET" and scope["path"] in PRECOMPRESSED_PATHS
+        if encoding is None and not cacheable:
+            await self.app(scope, receive, send)
+            return
+
+        if cacheable:
+            params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+            key = (scope["path"], tuple(params.get(name) for name in PRECOMPRESSED_PATHS[scope["path"]]))
+            # Read before the handler runs, so a write during it leaves the entry stale
+            generation = current_app_state.get().read_coalescer.generation
+            entry = self.cache.get(key)
+            if entry is not None and entry["generation"] == generation:
+                await self._send_entry(send, entry, encoding, request_headers)
+                return
+
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+        body = b"".join(chunks)
+        headers = MutableHeaders(raw=start["headers"])
+        content_type = headers.get("content-type", "")
+        if start["status"] != 200 or "content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+            await self._send(send, start, body)
+            return
+
+        if cacheable:
+            del headers["content-length"]
+            entry = {
+                "generation": generation,
+                "headers": list(headers.raw),
+                "etag": 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"',
+                "body": body,
+                "encoded": {},
+            }
+            self.cache.set(key, entry)
+            await self._send_entry(send, entry, encoding, request_headers)
+            return
+
+        if len(body) >= self.minimum_size:
+            body = await self._compress(body, encoding)
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(body))
+        headers.add_vary_header("Accept-Encoding")
+        await self._send(send, start, body)
+
+    async def _send_entry(self, send, entry: dict, encoding: Optional[str], request_headers: Headers):
+        headers = MutableHeaders(raw=list(entry["headers"]))
+        headers["etag"] = entry["etag"]
+        headers.add_vary_header("Accept-Encoding")
+        if entry["etag"] in request_headers.get("if-none-match", ""):
+            await self._send(send, {"type": "http.response.start", "status": 304, "headers": headers.raw}, b"")
+            return
+
+        body = entry["body"]
+        if encoding is not None and len(body) >= self.minimum_size:
+            compressed = entry["encoded"].get(encoding)
+            if compressed is None:
+                compressed = entry["encoded"][encoding] = await self._compress(body, encoding)
+            body = compressed
+            headers["content-encoding"] = encoding
+        headers["content-length"] = str(len(body))
+        await self._send(send, {"type": "http.response.start", "status": 200, "headers": headers.raw}, body)
+
+    async def _compress(self, body: bytes, encoding: str) -> bytes:
+        if len(body) >= self.offload_size:
+            return await run_in_threadpool(compress_body, body, encoding)
+        return compress_body(body, encoding)
+
+    async def _send(self, send, start, body: bytes):
+        await send(start)
+        await send({"type": "http.response.body", "body": body})
+
+# ===================== PROFILING =====================
+
+# Sampled frames are attributed to the first category matching from the leaf up
+PROFILE_CATEGORIES = (
+    ("mongo", ("/motor/", "/pymongo/", "/bson/", "/storage.py")),
+    ("http", ("/httpx/", "/httpcore/")),
+    ("validation", ("/pydantic/", "/pydantic_core/", "/fastapi/_compat.py", "/fastapi/dependencies/")),
+    ("serialization", ("/fastapi/encoders.py", "/json/", "/starlette/responses.py", "/gzip.py")),
+)
+PROFILE_MAX_DEPTH = 128
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+class RequestProfile:
+    """Stack samples and timings collected for one request"""
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.status_code = None
+        self.started_at = datetime.utcnow()
+        self.duration_ms = 0.0
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        # The request task and every task it spawns
+        self.tasks = weakref.WeakSet()
+        self.stacks = Counter()
+        self.cpu_ms = Counter()
+        self.timings = Counter()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_sample(self, stack: str, category: str, ms: float):
+        with self._lock:
+            self.stacks[stack] += 1
+            self.cpu_ms[category] += ms
+
+    def add_time(self, category: str, ms: float):
+        with self._lock:
+            self.timings[category] += ms
+
+    def finish(self, status_code: Optional[int]):
+        self.status_code = status_code
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "trigger": self.trigger,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 2),
+            # Awaited time, measured directly
+            "wait_ms": {k: round(v, 2) for k, v in self.timings.items()},
+            # Event loop time, estimated from the samples
+            "cpu_ms": {k: round(v, 2) for k, v in self.cpu_ms.items()},
+            "samples": sum(self.stacks.values()),
+        }
+
+    def collapsed(self, prefix: str = "") -> List[str]:
+        return [f"{prefix}{stack} {count}" for stack, count in self.stacks.items()]
+
+class RequestProfiler:
+    """Samples the event loop thread while profiled requests run and keeps the last N profiles"""
+
+    def __init__(self, interval_ms: float, buffer_size: int):
+        self.interval_ms = interval_ms
+        self.profiles = deque(maxlen=buffer_size)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self, profile: RequestProfile, keep: bool):
+        with self._lock:
+            self._active.discard(profile)
+        if keep:
+            self.profiles.append(profile)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        return next((p for p in self.profiles if p.id == profile_id), None)
+
+    def _sample(self):
+        last = time.perf_counter()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active)
+            frames = sys._current_frames()
+            # Weigh each sample by the time since the last one, ticks stretch under GIL contention
+            now = time.perf_counter()
+            elapsed_ms, last = (now - last) * 1000, now
+            running = {}
+            for profile in active:
+                if profile.loop not in running:
+                    running[profile.loop] = asyncio.current_task(profile.loop)
+                frame = frames.get(profile.thread_id)
+                if frame is not None and running[profile.loop] in profile.tasks:
+                    profile.add_sample(*collapse_stack(frame), elapsed_ms)
+            time.sleep(self.interval_ms / 1000)
+
+def collapse_stack(frame) -> tuple:
+    names = []
+    category = None
+    while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+        filename = frame.f_code.co_filename.replace("\\", "/")
+        if category is None:
+            category = next((name for name, parts in PROFILE_CATEGORIES if any(p in filename for p in parts)), None)
+        names.append(f"{Path(filename).name}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names)), category or "other"
+
+def profiled_task_factory(loop, coro, **kwargs):
+    # Tasks spawned while serving a profiled request are sampled as part of it
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.tasks.add(task)
+    return task
+
+@contextmanager
+def profile_span(category: str):
+    profile = current_profile.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.add_time(category, (time.perf_counter() - start) * 1000)
+
+class MongoProfileListener(monitoring.CommandListener):
+    """Adds driver-measured command time to the profile, Motor carries the context into its executor"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_time("mongo", event.duration_micros / 1000)
+
+monitoring.register(MongoProfileListener())
+
+class ProfilingMiddleware:
+    """Profiles requests carrying the admin X-Profile-Token header, or every request when a slow threshold is set"""
+
+    def __init__(self, app, token: str = PROFILING_TOKEN, slow_ms: float = PROFILE_SLOW_REQUEST_MS):
+        self.app = app
+        self.token = token
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = Headers(scope=scope).get("x-profile-token", "")
+        if self.token and requested and hmac.compare_digest(requested, self.token):
+            trigger = "header"
+        elif self.slow_ms > 0:
+            trigger = "slow"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(profiled_task_factory)
+        profiler = current_app_state.get().profiler
+        profile = RequestProfile(scope["method"], scope["path"], trigger)
+        profile.tasks.add(asyncio.current_task())
+        status = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if trigger == "header":
+                    headers = MutableHeaders(scope=message)
+                    headers["X-Profile-Id"] = profile.id
+            await send(message)
+
+        token = current_profile.set(profile)
+        profiler.start(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            profile.finish(status.get("code"))
+            profiler.stop(profile, keep=trigger == "header" or profile.duration_ms >= self.slow_ms)
+
 # ===================== MODELS =====================
 
 # Catalog Models
@@ -149,6 +887,18 @@ class ServiceMasterLink(BaseModel):
     service_id: str
     master_id: str
 
+class MasterServiceAssignment(BaseModel):
+    master_id: str
+    service_ids: List[str]
+
+class MasterServiceMatrix(BaseModel):
+    assignments: List[MasterServiceAssignment]
+
+class ServiceMasters(BaseModel):
+    service_id: str
+    service_name: str
+    masters: List[Master]
+
 # User Models
 class UserBase(BaseModel):
     phone: str
@@ -169,6 +919,26 @@ class User(UserBase):
     discount_percent: float = 0
     qr_md5: str = ""
 
+# Discount Card Models
+class CardVerifyRequest(BaseModel):
+    code: str
+    scanned_at: Optional[datetime] = None
+
+class CardBatchVerifyRequest(BaseModel):
+    scans: List[CardVerifyRequest]
+
+class CardVerification(BaseModel):
+    code: str
+    valid: bool
+    source: str = ""  # cache / db / signature
+    user_id: Optional[str] = None
+    user: Optional[User] = None
+    scanned_at: Optional[datetime] = None
+
+class SignedCard(BaseModel):
+    user_id: str
+    card: str
+
 # Cart Models
 class CartItemBase(BaseModel):
     type: str  # product or service
@@ -258,6 +1028,60 @@ class SettingsUpdate(BaseModel):
     server_address: Optional[str] = None
     access_code: Optional[str] = None
 
+# Profile Summary Models
+class OrderSummary(BaseModel):
+    id: str
+    created_at: datetime
+    total_amount: float
+    status: str = "pending"
+    items_count: int = 0
+    bonus_points_earned: int = 0
+
+class UserSummary(BaseModel):
+    user_id: str
+    full_name: str
+    phone: str
+    total_orders_count: int = 0
+    total_orders_amount: float = 0
+    bonus_points: int = 0
+    discount_percent: float = 0
+    qr_md5: str = ""
+    current_tier: Optional[LoyaltyRule] = None
+    next_tier: Optional[LoyaltyRule] = None
+    amount_to_next_tier: float = 0
+    tier_progress_percent: float = 100
+    recent_orders: List[OrderSummary] = []
+
+# Bulk Admin Models
+class BulkFilter(BaseModel):
+    ids: Optional[List[str]] = None
+    catalog_id: Optional[str] = None
+    is_visible: Optional[bool] = None
+
+class ProductBulkUpdate(BaseModel):
+    filter: BulkFilter
+    is_visible: Optional[bool] = None
+    price_uah: Optional[float] = None
+    price_change_percent: Optional[float] = None  # -10 = 10% cheaper
+    discount_percent: Optional[float] = None
+
+class ServiceBulkUpdate(BaseModel):
+    filter: BulkFilter
+    is_visible: Optional[bool] = None
+    price_uah: Optional[float] = None
+    price_change_percent: Optional[float] = None
+
+class BulkDelete(BaseModel):
+    filter: BulkFilter
+
+class OrderBulkStatusUpdate(BaseModel):
+    order_ids: List[str]
+    status: str
+    from_statuses: Optional[List[str]] = None  # only transition orders currently in these statuses
+
+class OrderBulkDelete(BaseModel):
+    order_ids: List[str]
+
 # ===================== CATALOG ENDPOINTS =====================
 
 @api_router.get("/")
@@ -268,6 +1092,7 @@ async def root():
 async def create_catalog(catalog: CatalogCreate):
     catalog_obj = Catalog(**catalog.dict())
     await db.catalogs.insert_one(catalog_obj.dict())
+    read_coalescer.invalidate()
     return catalog_obj
 
 @api_router.get("/catalogs", response_model=List[Catalog])
@@ -277,8 +1102,12 @@ async def get_catalogs(visible_only: bool = False, is_product: Optional[bool] =
         query["is_visible"] = True
     if is_product is not None:
         query["is_product"] = is_product
-    catalogs = await db.catalogs.find(query).to_list(1000)
-    return [Catalog(**c) for c in catalogs]
+
+    async def load():
+        catalogs = await db.catalogs.find(query).to_list(1000)
+        return [Catalog(**c) for c in catalogs]
+
+    return await coalesced_response(("catalogs", visible_only, is_product), load)
 
 @api_router.get("/catalogs/{catalog_id}", response_model=Catalog)
 async def get_catalog(catalog_id: str):
@@ -295,6 +1124,7 @@ async def update_catalog(catalog_id: str, catalog_update: CatalogUpdate):
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Catalog not found")
     catalog = await db.catalogs.find_one({"id": catalog_id})
+    read_coalescer.invalidate()
     return Catalog(**catalog)
 
 @api_router.delete("/catalogs/{catalog_id}")
@@ -302,6 +1132,9 @@ async def delete_catalog(catalog_id: str):
     result = await db.catalogs.delete_one({"id": catalog_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Catalog not found")
+    # Products, services and master links are removed in the background
+    await schedule_cascade("catalog", catalog_id)
+    read_coalescer.invalidate()
     return {"message": "Catalog deleted"}
 
 # ===================== PRODUCT ENDPOINTS =====================
@@ -314,6 +1147,7 @@ async def create_product(product: ProductCreate):
         raise HTTPException(status_code=404, detail="Catalog not found")
     product_obj = Product(**product.dict())
     await db.products.insert_one(product_obj.dict())
+    read_coalescer.invalidate()
     return product_obj
 
 @api_router.get("/products", response_model=List[Product])
@@ -323,8 +1157,12 @@ async def get_products(catalog_id: Optional[str] = None, visible_only: bool = Fa
         query["catalog_id"] = catalog_id
     if visible_only:
         query["is_visible"] = True
-    products = await db.products.find(query).to_list(1000)
-    return [Product(**p) for p in products]
+
+    async def load():
+        products = await db.products.find(query).to_list(1000)
+        return [Product(**p) for p in products]
+
+    return await coalesced_response(("products", catalog_id, visible_only), load)
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
@@ -341,6 +1179,7 @@ async def update_product(product_id: str, product_update: ProductUpdate):
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
     product = await db.products.find_one({"id": product_id})
+    read_coalescer.invalidate()
     return Product(**product)
 
 @api_router.delete("/products/{product_id}")
@@ -348,6 +1187,7 @@ async def delete_product(product_id: str):
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    read_coalescer.invalidate()
     return {"message": "Product deleted"}
 
 # ===================== SERVICE ENDPOINTS =====================
@@ -359,6 +1199,7 @@ async def create_service(service: ServiceCreate):
         raise HTTPException(status_code=404, detail="Catalog not found")
     service_obj = Service(**service.dict())
     await db.services.insert_one(service_obj.dict())
+    read_coalescer.invalidate()
     return service_obj
 
 @api_router.get("/services", response_model=List[Service])
@@ -386,6 +1227,7 @@ async def update_service(service_id: str, service_update: ServiceUpdate):
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Service not found")
     service = await db.services.find_one({"id": service_id})
+    read_coalescer.invalidate()
     return Service(**service)
 
 @api_router.delete("/services/{service_id}")
@@ -393,6 +1235,8 @@ async def delete_service(service_id: str):
     result = await db.services.delete_one({"id": service_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Service not found")
+    await schedule_cascade("service", service_id)
+    read_coalescer.invalidate()
     return {"message": "Service deleted"}
 
 # ===================== MASTER ENDPOINTS =====================
@@ -401,6 +1245,7 @@ async def delete_service(service_id: str):
 async def create_master(master: MasterCreate):
     master_obj = Master(**master.dict())
     await db.masters.insert_one(master_obj.dict())
+    read_coalescer.invalidate()
     return master_obj
 
 @api_router.get("/masters", response_model=List[Master])
@@ -423,6 +1268,7 @@ async def update_master(master_id: str, master_update: MasterUpdate):
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Master not found")
     master = await db.masters.find_one({"id": master_id})
+    read_coalescer.invalidate()
     return Master(**master)
 
 @api_router.delete("/masters/{master_id}")
@@ -430,60 +1276,291 @@ async def delete_master(master_id: str):
     result = await db.masters.delete_one({"id": master_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Master not found")
+    read_coalescer.invalidate()
     return {"message": "Master deleted"}
 
 # Link/Unlink service to master
 @api_router.post("/masters/{master_id}/services/{service_id}")
 async def link_service_to_master(master_id: str, service_id: str):
-    master = await db.masters.find_one({"id": master_id})
-    if not master:
-        raise HTTPException(status_code=404, detail="Master not found")
-    service = await db.services.find_one({"id": service_id})
+    service = await db.services.find_one({"id": service_id}, {"_id": 0, "id": 1})
     if not service:
         raise HTTPException(status_code=404, detail="Service not found")
-    
-    service_ids = master.get("service_ids", [])
-    if service_id not in service_ids:
-        service_ids.append(service_id)
-        await db.masters.update_one({"id": master_id}, {"$set": {"service_ids": service_ids}})
+    result = await db.masters.update_one({"id": master_id}, {"$addToSet": {"service_ids": service_id}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Master not found")
+    read_coalescer.invalidate()
     return {"message": "Service linked to master"}
 
 @api_router.delete("/masters/{master_id}/services/{service_id}")
 async def unlink_service_from_master(master_id: str, service_id: str):
-    master = await db.masters.find_one({"id": master_id})
-    if not master:
+    result = await db.masters.update_one({"id": master_id}, {"$pull": {"service_ids": service_id}})
+    if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Master not found")
-    
-    service_ids = master.get("service_ids", [])
-    if service_id in service_ids:
-        service_ids.remove(service_id)
-        await db.masters.update_one({"id": master_id}, {"$set": {"service_ids": service_ids}})
+    read_coalescer.invalidate()
     return {"message": "Service unlinked from master"}
 
 @api_router.get("/services/{service_id}/masters", response_model=List[Master])
 async def get_masters_for_service(service_id: str):
-    masters = await db.masters.find({"service_ids": service_id, "is_active": True}).to_list(1000)
-    return [Master(**m) for m in masters]
+    async def load():
+        masters = await db.masters.find({"service_ids": service_id, "is_active": True}).to_list(1000)
+        return [Master(**m) for m in masters]
+
+    return await coalesced_response(("service_masters", service_id), load)
+
+@api_router.put("/admin/masters/assignments")
+async def set_master_assignments(matrix: MasterServiceMatrix):
+    """Replace service_ids of every listed master in one bulk_write"""
+    requested = {sid for a in matrix.assignments for sid in a.service_ids}
+    missing = await find_missing_ids(db.services, list(requested))
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown services: {', '.join(missing)}")
+    if not matrix.assignments:
+        return {"matched": 0, "modified": 0}
+    operations = [
+        UpdateOne({"id": a.master_id}, {"$set": {"service_ids": list(dict.fromkeys(a.service_ids))}})
+        for a in matrix.assignments
+    ]
+    result = await db.masters.bulk_write(operations, ordered=False)
+    read_coalescer.invalidate()
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+@api_router.get("/masters/{master_id}/services", response_model=List[Service])
+async def get_services_for_master(master_id: str, visible_only: bool = False):
+    """Services a master offers, joined server-side in one round trip"""
+    pipeline = [
+        {"$match": {"id": master_id}},
+        {"$lookup": {"from": "services", "localField": "service_ids", "foreignField": "id", "as": "services"}},
+        {"$project": {"_id": 0, "services": 1}},
+    ]
+    masters = await db.masters.aggregate(pipeline).to_list(1)
+    if not masters:
+        raise HTTPException(status_code=404, detail="Master not found")
+    services = masters[0]["services"]
+    if visible_only:
+        services = [srv for srv in services if srv.get("is_visible")]
+    return [Service(**srv) for srv in services]
+
+@api_router.get("/catalogs/{catalog_id}/service-masters", response_model=List[ServiceMasters])
+async def get_service_masters_for_catalog(catalog_id: str, visible_only: bool = False):
+    """Active masters of every service in a catalog, using the masters.service_ids index"""
+    match = {"catalog_id": catalog_id}
+    if visible_only:
+        match["is_visible"] = True
+    pipeline = [
+        {"$match": match},
+        {"$lookup": {"from": "masters", "localField": "id", "foreignField": "service_ids", "as": "masters"}},
+        {"$project": {"_id": 0, "id": 1, "name": 1, "masters": 1}},
+    ]
+    rows = await db.services.aggregate(pipeline).to_list(None)
+    return [
+        ServiceMasters(
+            service_id=row["id"],
+            service_name=row["name"],
+            masters=[Master(**m) for m in row["masters"] if m.get("is_active")]
+        )
+        for row in rows
+    ]
+
+# ===================== REFERENTIAL INTEGRITY =====================
+
+async def pull_service_links(service_ids: List[str]) -> int:
+    """Remove service ids from every master in one multi-document update"""
+    if not service_ids:
+        return 0
+    result = await db.masters.update_many(
+        {"service_ids": {"$in": service_ids}},
+        {"$pull": {"service_ids": {"$in": service_ids}}}
+    )
+    return result.modified_count
+
+async def cascade_catalog(catalog_id: str) -> dict:
+    # Unlink first so a crash before the delete can simply be retried
+    services = await db.services.find({"catalog_id": catalog_id}, {"_id": 0, "id": 1}).to_list(None)
+    service_ids = [srv["id"] for srv in services]
+    masters_updated = await pull_service_links(service_ids)
+    services_result = await db.services.delete_many({"catalog_id": catalog_id})
+    products_result = await db.products.delete_many({"catalog_id": catalog_id})
+    return {
+        "masters_updated": masters_updated,
+        "services_deleted": services_result.deleted_count,
+        "products_deleted": products_result.deleted_count,
+    }
+
+async def cascade_service(service_id: str) -> dict:
+    return {"masters_updated": await pull_service_links([service_id])}
+
+CASCADE_HANDLERS = {
+    "catalog": cascade_catalog,
+    "service": cascade_service,
+}
+
+async def schedule_cascade(kind: str, target_id: str):
+    """Persist a cascade job so it survives restarts, then run it in the background"""
+    now = datetime.utcnow()
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "target_id": target_id,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await db.cascade_jobs.insert_one(job)
+    spawn_background(run_cascade_job(job))
+
+async def run_cascade_job(job: dict):
+    await db.cascade_jobs.update_one(
+        {"id": job["id"]},
+        {"$inc": {"attempts": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    try:
+        result = await CASCADE_HANDLERS[job["kind"]](job["target_id"])
+    except Exception as e:
+        logger.error("Cascade job %s (%s %s) failed: %s", job['id'], job['kind'], job['target_id'], e)
+        await db.cascade_jobs.update_one({"id": job["id"]}, {"$set": {"last_error": str(e)}})
+        return
+    await db.cascade_jobs.update_one(
+        {"id": job["id"]},
+        {"$set": {"status": "done", "result": result, "updated_at": datetime.utcnow()}}
+    )
+    read_coalescer.invalidate()
+    logger.info("Cascade job %s (%s %s) done: %s", job['id'], job['kind'], job['target_id'], result)
+
+async def resume_cascade_jobs():
+    """Re-run jobs left pending by a restart or a failure, every step is idempotent"""
+    jobs = await db.cascade_jobs.find({"status": "pending"}, {"_id": 0}).to_list(None)
+    for job in jobs:
+        await run_cascade_job(job)
+
+async def run_migration(name: str, migrate, rerun: bool = False) -> Optional[dict]:
+    """Run a one-off data migration on a single instance, None if it is done or running elsewhere
+
+    A migration document doubles as the lock and the done marker. A lock older than
+    MIGRATION_LOCK_SECONDS belongs to a dead instance and is taken over.
+    """
+    now = datetime.utcnow()
+    try:
+        await db.migrations.insert_one({"id": name, "status": "running", "started_at": now})
+    except DuplicateKeyError:
+        claimable = [{"status": "running", "started_at": {"$lt": now - timedelta(seconds=MIGRATION_LOCK_SECONDS)}}]
+        if rerun:
+            claimable.append({"status": "done"})
+        claimed = await db.migrations.find_one_and_update(
+            {"id": name, "$or": claimable},
+            {"$set": {"status": "running", "started_at": now}}
+        )
+        if not claimed:
+            return None
+    try:
+        result = await migrate()
+    except Exception:
+        # Release the lock so the next boot retries
+        await db.migrations.delete_one({"id": name, "started_at": now})
+        raise
+    await db.migrations.update_one(
+        {"id": name},
+        {"$set": {"status": "done", "result": result, "finished_at": datetime.utcnow()}}
+    )
+    return result
+
+async def find_missing_ids(collection, ids: List[str]) -> List[str]:
+    if not ids:
+        return []
+    existing = await collection.find({"id": {"$in": ids}}, {"_id": 0, "id": 1}).to_list(None)
+    existing_ids = {doc["id"] for doc in existing}
+    return [i for i in ids if i not in existing_ids]
+
+async def check_integrity(repair: bool = False) -> dict:
+    """Find (and optionally remove) children pointing at deleted parents"""
+    product_catalogs = await db.products.distinct("catalog_id")
+    service_catalogs = await db.services.distinct("catalog_id")
+    missing_catalogs = await find_missing_ids(db.catalogs, list(set(product_catalogs) | set(service_catalogs)))
+    linked_services = await db.masters.distinct("service_ids")
+    missing_services = await find_missing_ids(db.services, linked_services)
+
+    orphan_query = {"catalog_id": {"$in": missing_catalogs}}
+    report = {
+        "missing_catalog_ids": missing_catalogs,
+        "orphan_products": await db.products.count_documents(orphan_query) if missing_catalogs else 0,
+        "orphan_services": await db.services.count_documents(orphan_query) if missing_catalogs else 0,
+        "dangling_service_ids": missing_services,
+        "repaired": False,
+    }
+    if repair and (missing_catalogs or missing_services):
+        orphan_services = await db.services.find(orphan_query, {"_id": 0, "id": 1}).to_list(None)
+        await pull_service_links(missing_services + [srv["id"] for srv in orphan_services])
+        await db.services.delete_many(orphan_query)
+        await db.products.delete_many(orphan_query)
+        read_coalescer.invalidate()
+        report["repaired"] = True
+    return report
+
+async def run_integrity_checks():
+    while True:
+        await asyncio.sleep(INTEGRITY_CHECK_INTERVAL_SECONDS)
+        try:
+            await resume_cascade_jobs()
+            report = await check_integrity(repair=INTEGRITY_AUTO_REPAIR)
+            if report["missing_catalog_ids"] or report["dangling_service_ids"]:
+                logger.warning("Integrity check found orphans: %s", report)
+        except Exception as e:
+            logger.error("Integrity check failed: %s", e)
+
+@api_router.get("/admin/integrity")
+async def get_integrity_report(repair: bool = False):
+    """Report orphaned products/services and dangling master links, repair with ?repair=true"""
+    return await check_integrity(repair=repair)
 
 # ===================== USER ENDPOINTS =====================
 
+def normalize_phone(phone: str) -> str:
+    """Canonical +380XXXXXXXXX form, so 0..., 380... and +380... variants of a number match"""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) == 9:
+        digits = "380" + digits
+    elif len(digits) == 10 and digits.startswith("0"):
+        digits = "38" + digits
+    elif len(digits) == 11 and digits.startswith("80"):
+        digits = "3" + digits
+    return f"+{digits}" if digits else ""
+
+def normalize_phone_prefix(phone: str) -> str:
+    """Leading part of a phone in the normalize_phone form, for prefix searches"""
+    digits = re.sub(r"\D", "", phone or "")
+    if not digits or phone.strip().startswith("+") or digits.startswith("380"):
+        return f"+{digits}" if digits else ""
+    if digits.startswith("80"):
+        return f"+3{digits}"
+    if digits.startswith("0"):
+        return f"+38{digits}"
+    return f"+380{digits}"
+
 @api_router.post("/users/login", response_model=User)
 async def login_or_register(user_data: UserCreate):
-    # Check if user exists
-    existing_user = await db.users.find_one({"phone": user_data.phone})
-    if existing_user:
-        return User(**existing_user)
+    phone = normalize_phone(user_data.phone)
+    if not phone:
+        raise HTTPException(status_code=400, detail="Phone is required")
     
-    # Create new user with discount card
-    user_obj = User(**user_data.dict())
+    # New user with discount card, only written if the phone is not registered yet
+    user_obj = User(**{**user_data.dict(), "phone": phone})
     qr_string = f"{user_obj.phone};{user_obj.full_name};{user_obj.registration_date.isoformat()}"
     user_obj.qr_md5 = hashlib.md5(qr_string.encode()).hexdigest()
-    await db.users.insert_one(user_obj.dict())
-    return user_obj
+    try:
+        user = await db.users.find_one_and_update(
+            {"phone": phone},
+            {"$setOnInsert": {**user_obj.dict(exclude={"phone"}), "recent_orders": []}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A simultaneous first login with the same phone won the upsert
+        user = await db.users.find_one({"phone": phone})
+    return User(**user)
 
 @api_router.get("/users", response_model=List[User])
 async def get_users():
-    users = await db.users.find().to_list(1000)
+    users = await db.users.find({}, {"recent_orders": 0}).to_list(1000)
     return [User(**u) for u in users]
 
 @api_router.get("/users/{user_id}", response_model=User)
@@ -493,24 +1570,245 @@ async def get_user(user_id: str):
         raise HTTPException(status_code=404, detail="User not found")
     return User(**user)
 
+@api_router.get("/users/{user_id}/summary", response_model=UserSummary)
+async def get_user_summary(user_id: str):
+    """Everything the profile screen needs from one indexed read of the user"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if "recent_orders" not in user:
+        # Users registered before the summary existed get it backfilled once
+        orders = await db.orders.find({"user_id": user_id}).sort("created_at", -1).to_list(PROFILE_RECENT_ORDERS)
+        user["recent_orders"] = [order_summary(Order(**o)) for o in orders]
+        await db.users.update_one({"id": user_id}, {"$set": {"recent_orders": user["recent_orders"]}})
+
+    summary = UserSummary(
+        user_id=user["id"],
+        full_name=user.get("full_name", ""),
+        phone=user.get("phone", ""),
+        total_orders_count=user.get("total_orders_count", 0),
+        total_orders_amount=user.get("total_orders_amount", 0),
+        bonus_points=user.get("bonus_points", 0),
+        discount_percent=user.get("discount_percent", 0),
+        qr_md5=user.get("qr_md5", ""),
+        recent_orders=[OrderSummary(**o) for o in user["recent_orders"]],
+    )
+    rules = await get_cached_loyalty_rules()
+    current = find_loyalty_rule(summary.total_orders_amount, rules)
+    higher = [r for r in rules if r.get("min_total_amount", 0) > summary.total_orders_amount]
+    if current:
+        summary.current_tier = LoyaltyRule(**current)
+    if higher:
+        # Rules are sorted descending, the last higher one is the next tier
+        summary.next_tier = LoyaltyRule(**higher[-1])
+        floor = summary.current_tier.min_total_amount if summary.current_tier else 0
+        span = summary.next_tier.min_total_amount - floor
+        summary.amount_to_next_tier = summary.next_tier.min_total_amount - summary.total_orders_amount
+        summary.tier_progress_percent = round((summary.total_orders_amount - floor) / span * 100, 1) if span else 0
+    return summary
+
 @api_router.get("/users/phone/{phone}", response_model=User)
 async def get_user_by_phone(phone: str):
-    user = await db.users.find_one({"phone": phone})
+    user = await db.users.find_one({"phone": normalize_phone(phone)})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return User(**user)
 
+async def merge_duplicate_users() -> dict:
+    """Normalize stored phones and fold users sharing a phone into the oldest account
+
+    Orders and carts of the duplicates move to the kept user, whose totals are then
+    recomputed from orders, so a repeated or interrupted run converges to the same
+    state. The profile summary is dropped and rebuilt from orders on the next read.
+    """
+    groups = {}
+    scanned = 0
+    async for user in db.users.find({}, {"_id": 0, "id": 1, "phone": 1, "registration_date": 1, "discount_percent": 1}):
+        scanned += 1
+        groups.setdefault(normalize_phone(user.get("phone", "")), []).append(user)
+    
+    user_ops = []
+    order_ops = []
+    merged_into = {}
+    normalized = 0
+    for phone, group in groups.items():
+        if not phone:
+            continue
+        group.sort(key=lambda u: u.get("registration_date") or datetime.max)
+        kept, duplicates = group[0], group[1:]
+        if not duplicates:
+            if kept.get("phone") != phone:
+                user_ops.append(UpdateOne({"id": kept["id"]}, {"$set": {"phone": phone}}))
+                normalized += 1
+            continue
+        duplicate_ids = [u["id"] for u in duplicates]
+        merged_into.update({user_id: kept["id"] for user_id in duplicate_ids})
+        order_ops.append(UpdateMany({"user_id": {"$in": duplicate_ids}}, {"$set": {"user_id": kept["id"]}}))
+        user_ops.append(UpdateOne({"id": kept["id"]}, {
+            "$set": {"phone": phone},
+            "$max": {"discount_percent": max(u.get("discount_percent", 0) for u in group)},
+            "$unset": {"recent_orders": ""}
+        }))
+    
+    if order_ops:
+        await db.orders.bulk_write(order_ops, ordered=False)
+    if merged_into:
+        await merge_duplicate_carts(merged_into)
+    if user_ops or merged_into:
+        # Duplicates go first, a kept user may take over the canonical phone one of them holds
+        removals = [DeleteMany({"id": {"$in": list(merged_into)}})] if merged_into else []
+        await db.users.bulk_write(removals + user_ops, ordered=True)
+    if merged_into:
+        await recompute_user_totals(list(set(merged_into.values())))
+    
+    return {
+        "users_scanned": scanned,
+        "users_merged": len(merged_into),
+        "phones_normalized": normalized
+    }
+
+async def recompute_user_totals(user_ids: List[str]):
+    """Set the order totals of the given users from their counted orders"""
+    totals = {
+        t["_id"]: t
+        for t in await db.orders.aggregate([
+            {"$match": {"user_id": {"$in": user_ids}, "status": {"$nin": UNCOUNTED_ORDER_STATUSES}}},
+            {"$group": {
+                "_id": "$user_id",
+                "total_orders_count": {"$sum": 1},
+                "total_orders_amount": {"$sum": "$total_amount"},
+                "bonus_points": {"$sum": "$bonus_points_earned"},
+            }},
+        ]).to_list(None)
+    }
+    await db.users.bulk_write([
+        UpdateOne({"id": user_id}, {"$set": {
+            "total_orders_count": totals.get(user_id, {}).get("total_orders_count", 0),
+            "total_orders_amount": totals.get(user_id, {}).get("total_orders_amount", 0),
+            "bonus_points": totals.get(user_id, {}).get("bonus_points", 0),
+        }})
+        for user_id in user_ids
+    ], ordered=False)
+
+async def merge_duplicate_carts(merged_into: dict):
+    # Carts are unique per user: the newest duplicate cart moves over if the kept user has none
+    user_ids = list(merged_into) + list(set(merged_into.values()))
+    carts = await db.carts.find({"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "updated_at": 1}).to_list(None)
+    has_cart = {c["user_id"] for c in carts if c["user_id"] not in merged_into}
+    cart_ops = []
+    for cart in sorted(carts, key=lambda c: c.get("updated_at") or datetime.min, reverse=True):
+        kept_id = merged_into.get(cart["user_id"])
+        if kept_id is None:
+            continue
+        if kept_id in has_cart:
+            cart_ops.append(DeleteOne({"user_id": cart["user_id"]}))
+        else:
+            cart_ops.append(UpdateOne({"user_id": cart["user_id"]}, {"$set": {"user_id": kept_id}}))
+            has_cart.add(kept_id)
+    if cart_ops:
+        await db.carts.bulk_write(cart_ops, ordered=True)
+
+@api_router.post("/admin/users/merge-duplicates")
+async def trigger_merge_duplicate_users():
+    """Normalize phones and merge users registered more than once, then build the phone index"""
+    report = await run_migration("merge_duplicate_users", merge_duplicate_users, rerun=True)
+    if report is None:
+        raise HTTPException(status_code=409, detail="Merge is already running")
+    await ensure_index(db.users, "phone", unique=True, partialFilterExpression={"phone": {"$gt": ""}})
+    return report
+
+# ===================== DISCOUNT CARD ENDPOINTS =====================
+
+def sign_card(user_id: str) -> str:
+    """Build an HMAC-signed card string that can be checked without the DB"""
+    payload = f"{SIGNED_CARD_PREFIX}.{user_id}"
+    digest = hmac.new(CARD_SIGNING_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    signature = base64.urlsafe_b64encode(digest[:16]).decode().rstrip("=")
+    return f"{payload}.{signature}"
+
+def verify_signed_card(code: str) -> Optional[str]:
+    """Return user_id for a correctly signed card, None otherwise"""
+    parts = code.split(".")
+    if len(parts) != 3 or parts[0] != SIGNED_CARD_PREFIX:
+        return None
+    expected = sign_card(parts[1])
+    if not hmac.compare_digest(expected, code):
+        return None
+    return parts[1]
+
+def is_signed_card(code: str) -> bool:
+    return bool(CARD_SIGNING_SECRET) and code.startswith(f"{SIGNED_CARD_PREFIX}.")
+
+async def verify_cards(scans: List[CardVerifyRequest]) -> List[CardVerification]:
+    """Resolve scanned cards: signature check, then LRU cache, then one $in query for the misses"""
+    results = []
+    missing = set()
+    for scan in scans:
+        code = scan.code.strip()
+        result = CardVerification(code=code, valid=False, scanned_at=scan.scanned_at)
+        if is_signed_card(code):
+            user_id = verify_signed_card(code)
+            if user_id:
+                result.valid = True
+                result.source = "signature"
+                result.user_id = user_id
+        else:
+            cached = card_cache.get(code)
+            if cached is not None:
+                result.valid = True
+                result.source = "cache"
+                result.user_id = cached.id
+                result.user = cached
+            elif code:
+                missing.add(code)
+        results.append(result)
+
+    if missing:
+        users = await db.users.find({"qr_md5": {"$in": list(missing)}}).to_list(len(missing))
+        found = {}
+        for u in users:
+            user = User(**u)
+            found[user.qr_md5] = user
+            card_cache.set(user.qr_md5, user)
+        for result in results:
+            if result.code in found:
+                result.valid = True
+                result.source = "db"
+                result.user_id = found[result.code].id
+                result.user = found[result.code]
+    return results
+
+@api_router.post("/cards/verify", response_model=CardVerification)
+async def verify_card(scan: CardVerifyRequest):
+    """Resolve a scanned discount card QR to its user"""
+    result = (await verify_cards([scan]))[0]
+    if not result.valid:
+        raise HTTPException(status_code=404, detail="Card not found")
+    return result
+
+@api_router.post("/cards/verify/batch", response_model=List[CardVerification])
+async def verify_cards_batch(batch: CardBatchVerifyRequest):
+    """Resolve a queue of offline scans in one round trip, results in scan order"""
+    return await verify_cards(batch.scans)
+
+@api_router.get("/cards/{user_id}/signed", response_model=SignedCard)
+async def get_signed_card(user_id: str):
+    """Issue an HMAC-signed card for offline verification"""
+    if not CARD_SIGNING_SECRET:
+        raise HTTPException(status_code=404, detail="Signed cards are not enabled")
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return SignedCard(user_id=user_id, card=sign_card(user_id))
+
 # ===================== CART ENDPOINTS =====================
 
 @api_router.get("/cart/{user_id}", response_model=Cart)
 async def get_user_cart(user_id: str):
-    """Get user's cart"""
+    """Get user's cart, the document is only created when the first item is added"""
     cart = await db.carts.find_one({"user_id": user_id})
     if not cart:
-        # Create empty cart
-        new_cart = Cart(user_id=user_id, items=[])
-        await db.carts.insert_one(new_cart.dict())
-        return new_cart
+        return Cart(user_id=user_id, items=[])
     return Cart(**cart)
 
 @api_router.post("/cart/{user_id}/items")
@@ -519,11 +1817,19 @@ async def add_item_to_cart(user_id: str, item: CartItemCreate):
     cart = await db.carts.find_one({"user_id": user_id})
     
     if not cart:
-        # Create new cart with item
+        # Create new cart with item, as an upsert so a double tap cannot create two carts
         cart_item = CartItem(**item.dict())
         new_cart = Cart(user_id=user_id, items=[cart_item])
-        await db.carts.insert_one(new_cart.dict())
-        return {"success": True, "message": "Item added to cart"}
+        try:
+            result = await db.carts.update_one(
+                {"user_id": user_id}, {"$setOnInsert": new_cart.dict(exclude={"user_id"})}, upsert=True
+            )
+            if result.upserted_id is not None:
+                return {"success": True, "message": "Item added to cart"}
+        except DuplicateKeyError:
+            pass
+        # A concurrent add created the cart first, add to it instead
+        cart = await db.carts.find_one({"user_id": user_id})
     
     # Check if item already exists
     items = [CartItem(**i) for i in cart.get("items", [])]
@@ -598,56 +1904,227 @@ async def remove_cart_item(user_id: str, item_id: str):
 @api_router.delete("/cart/{user_id}")
 async def clear_cart(user_id: str):
     """Clear user's cart"""
-    await db.carts.update_one(
-        {"user_id": user_id},
-        {"$set": {"items": [], "updated_at": datetime.utcnow()}}
-    )
+    await db.carts.delete_one({"user_id": user_id})
     return {"success": True, "message": "Cart cleared"}
 
+# ===================== CART LIFECYCLE =====================
+
+async def log_cart_expiry_warning(carts: List[dict]):
+    for cart in carts:
+        logger.info("Cart of user %s with %d items expires soon", cart['user_id'], len(cart.get('items', [])))
+
+# Async callbacks receiving carts that are about to expire (e.g. to send a reminder)
+cart_expiry_hooks = [log_cart_expiry_warning]
+
+async def compact_carts() -> dict:
+    """Warn about carts close to expiry, then bulk-delete expired and empty carts"""
+    now = datetime.utcnow()
+    stats = {"warned": 0, "expired_deleted": 0, "empty_deleted": 0}
+
+    if CART_TTL_DAYS > 0:
+        expire_before = now - timedelta(days=CART_TTL_DAYS)
+        warn_before = expire_before + timedelta(hours=CART_EXPIRY_WARNING_HOURS)
+        # Carts that were not warned since their last update
+        warn_query = {
+            "updated_at": {"$lt": warn_before},
+            "items.0": {"$exists": True},
+            "$expr": {"$lt": [{"$ifNull": ["$expiry_warned_at", datetime.min]}, "$updated_at"]},
+        }
+        to_warn = await db.carts.find(
+            warn_query, {"_id": 0, "id": 1, "user_id": 1, "items": 1, "updated_at": 1}
+        ).to_list(None)
+        if to_warn:
+            for hook in cart_expiry_hooks:
+                try:
+                    await hook(to_warn)
+                except Exception as e:
+                    logger.error("Cart expiry hook failed: %s", e)
+            await db.carts.update_many(
+                {"id": {"$in": [c["id"] for c in to_warn]}},
+                {"$set": {"expiry_warned_at": now}}
+            )
+            stats["warned"] = len(to_warn)
+
+        # Only carts whose owner has been warned are removed here, the TTL index is the backstop
+        result = await db.carts.delete_many({
+            "updated_at": {"$lt": expire_before},
+            "expiry_warned_at": {"$exists": True},
+        })
+        stats["expired_deleted"] = result.deleted_count
+
+    result = await db.carts.delete_many({
+        "items": {"$size": 0},
+        "updated_at": {"$lt": now - timedelta(minutes=CART_EMPTY_GRACE_MINUTES)},
+    })
+    stats["empty_deleted"] = result.deleted_count
+    return stats
+
+async def run_cart_compaction():
+    while True:
+        await asyncio.sleep(CART_COMPACTION_INTERVAL_SECONDS)
+        try:
+            stats = await compact_carts()
+            logger.info("Cart compaction finished: %s", stats)
+        except Exception as e:
+            logger.error("Cart compaction failed: %s", e)
+
+@api_router.post("/admin/carts/compact")
+async def trigger_cart_compaction():
+    """Run cart compaction immediately"""
+    return await compact_carts()
+
 # ===================== ORDER ENDPOINTS =====================
 
 @api_router.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate):
-    # Get user
-    user = await db.users.find_one({"id": order_data.user_id})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def create_order(order_data: OrderCreate, idempotency_key: Optional[str] = Header(None)):
+    if not idempotency_key:
+        return await place_order(order_data)
     
-    # Calculate loyalty
-    loyalty_rules = await db.loyalty_rules.find().sort("min_total_amount", -1).to_list(100)
-    new_total = user.get("total_orders_amount", 0) + order_data.total_amount
+    # Concurrent duplicates on this instance wait for the first submission
+    submissions = current_app_state.get().order_submissions
+    key = (order_data.user_id, idempotency_key)
+    request_hash = order_request_hash(order_data)
+    submission = submissions.get(key)
+    if submission is None:
+        task = asyncio.ensure_future(place_order(order_data, idempotency_key, request_hash))
+        submission = submissions[key] = (request_hash, task)
+        task.add_done_callback(lambda t: finish_order_submission(submissions, key, t))
+    elif submission[0] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different order")
+    # Shield so a disconnecting client does not abort the order half way
+    return await asyncio.shield(submission[1])
+
+def finish_order_submission(submissions: dict, key: tuple, task):
+    submissions.pop(key, None)
+    if not task.cancelled():
+        # Mark the error retrieved, the awaiting request reports it
+        task.exception()
+
+def order_request_hash(order_data: OrderCreate) -> str:
+    payload = json.dumps(jsonable_encoder(order_data), sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def claim_idempotency_key(user_id: str, key: str, request_hash: str, order_id: str) -> Tuple[Optional[Order], str]:
+    """Reserve the key for a new order, returns the order it was already used for or the id to create it under
+
+    A claim whose order has not appeared IDEMPOTENCY_WAIT_SECONDS after it was made
+    belongs to a submission that died or stalled half way, a retry takes it over. The
+    order id stays the one first claimed, so a stalled submission finishing late and
+    its retry cannot both insert an order.
+    """
+    now = datetime.utcnow()
+    try:
+        await db.idempotency_keys.insert_one({
+            "user_id": user_id,
+            "key": key,
+            "request_hash": request_hash,
+            "order_id": order_id,
+            "state": "pending",
+            "claimed_at": now,
+            "created_at": now
+        })
+        return None, order_id
+    except DuplicateKeyError:
+        pass
+    
+    claim = await db.idempotency_keys.find_one({"user_id": user_id, "key": key}, {"_id": 0})
+    if claim and claim["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different order")
     
-    bonus_points = 0
-    user_discount = user.get("discount_percent", 0)
+    # The first submission may still be running on another instance
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while claim:
+        order = await db.orders.find_one({"id": claim["order_id"]}, {"_id": 0})
+        if order:
+            return Order(**order), order["id"]
+        claimed_at = claim.get("claimed_at") or claim["created_at"]
+        if datetime.utcnow() - claimed_at >= timedelta(seconds=IDEMPOTENCY_WAIT_SECONDS):
+            # Conditional on the claim time read, only one retry wins the takeover
+            taken = await db.idempotency_keys.find_one_and_update(
+                {"user_id": user_id, "key": key,
+                 "claimed_at": claim["claimed_at"] if "claimed_at" in claim else {"$exists": False}},
+                {"$set": {"state": "taken_over", "claimed_at": datetime.utcnow()}}
+            )
+            if taken:
+                return None, claim["order_id"]
+            claim = await db.idempotency_keys.find_one({"user_id": user_id, "key": key}, {"_id": 0})
+            continue
+        if time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.2)
+    raise HTTPException(status_code=409, detail="Order with this Idempotency-Key is being processed, retry")
+
+async def place_order(order_data: OrderCreate, idempotency_key: Optional[str] = None, request_hash: str = "") -> Order:
+    order_id = str(uuid.uuid4())
+    if idempotency_key:
+        original, order_id = await claim_idempotency_key(order_data.user_id, idempotency_key, request_hash, order_id)
+        if original:
+            return original
     
-    for rule in loyalty_rules:
-        if new_total >= rule.get("min_total_amount", 0):
+    try:
+        # Get user
+        user = await db.users.find_one({"id": order_data.user_id})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        # Calculate loyalty
+        loyalty_rules = await get_cached_loyalty_rules()
+        new_total = user.get("total_orders_amount", 0) + order_data.total_amount
+        
+        bonus_points = 0
+        user_discount = user.get("discount_percent", 0)
+        
+        rule = find_loyalty_rule(new_total, loyalty_rules)
+        if rule:
             bonus_points = rule.get("bonus_points", 0)
             user_discount = rule.get("discount_percent", 0)
-            break
+        
+        # Create order
+        order_obj = Order(
+            id=order_id,
+            user_id=order_data.user_id,
+            items=order_data.items,
+            total_amount=order_data.total_amount,
+            discount_percent=order_data.discount_percent,
+            bonus_points_earned=bonus_points
+        )
+        try:
+            await db.orders.insert_one(order_obj.dict())
+        except DuplicateKeyError:
+            # The submission this one took over from was only stalled and got there first
+            return Order(**await db.orders.find_one({"id": order_id}, {"_id": 0}))
+    except Exception:
+        # No order was written, expire the claim so a retry with the same key takes it over at once
+        if idempotency_key:
+            await db.idempotency_keys.update_one(
+                {"user_id": order_data.user_id, "key": idempotency_key},
+                {"$set": {"state": "failed", "claimed_at": datetime.min}}
+            )
+        raise
     
-    # Create order
-    order_obj = Order(
-        user_id=order_data.user_id,
-        items=order_data.items,
-        total_amount=order_data.total_amount,
-        discount_percent=order_data.discount_percent,
-        bonus_points_earned=bonus_points
-    )
-    await db.orders.insert_one(order_obj.dict())
-    
-    # Update user stats
-    await db.users.update_one(
-        {"id": order_data.user_id},
-        {
-            "$inc": {
-                "total_orders_count": 1,
-                "total_orders_amount": order_data.total_amount,
-                "bonus_points": bonus_points
-            },
-            "$set": {"discount_percent": user_discount}
-        }
-    )
+    # Update user stats and the profile summary
+    user_update = {
+        "$inc": {
+            "total_orders_count": 1,
+            "total_orders_amount": order_data.total_amount,
+            "bonus_points": bonus_points
+        },
+        "$set": {"discount_percent": user_discount}
+    }
+    if "recent_orders" in user:
+        user_update["$push"] = {"recent_orders": {
+            "$each": [order_summary(order_obj)],
+            "$position": 0,
+            "$slice": PROFILE_RECENT_ORDERS
+        }}
+    else:
+        # Users registered before the summary existed get it backfilled, new order included
+        orders = await db.orders.find({"user_id": order_data.user_id}).sort("created_at", -1).to_list(PROFILE_RECENT_ORDERS)
+        user_update["$set"]["recent_orders"] = [order_summary(Order(**o)) for o in orders]
+    await db.users.update_one({"id": order_data.user_id}, user_update)
+    
+    # Cached card holds stale stats now
+    card_cache.pop(user.get("qr_md5", ""))
     
     # Send to Telegram
     await send_telegram_notification(order_obj, User(**user))
@@ -663,11 +2140,105 @@ async def get_orders(user_id: str):
     orders = await db.orders.find({"user_id": user_id}).sort("created_at", -1).to_list(1000)
     return [Order(**o) for o in orders]
 
+ORDER_SORT_FIELDS = {"created_at", "total_amount"}
+# Counted after the +380 country code, which every stored phone shares
+PHONE_SEARCH_MIN_DIGITS = 4
+PHONE_SEARCH_MAX_USERS = 1000
+
+def encode_order_cursor(order: Order, sort_by: str) -> str:
+    value = getattr(order, sort_by)
+    payload = {"v": value.isoformat() if isinstance(value, datetime) else value, "id": order.id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_order_cursor(cursor: str, sort_by: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = payload["v"]
+        if sort_by == "created_at":
+            value = datetime.fromisoformat(value)
+        return value, payload["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.get("/admin/orders", response_model=List[Order])
-async def get_all_orders():
-    """Get all orders - admin only endpoint"""
-    orders = await db.orders.find().sort("created_at", -1).to_list(1000)
-    return [Order(**o) for o in orders]
+async def get_all_orders(
+    response: Response,
+    status: Optional[str] = Query(None, description="Comma-separated statuses"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    user_id: Optional[str] = None,
+    phone: Optional[str] = None,
+    item_type: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    sort_by: str = "created_at",
+    sort_order: str = "desc",
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None,
+):
+    """Get all orders - admin only endpoint
+
+    Filters are pushed down to Mongo. The next page cursor is returned in the
+    X-Next-Cursor header, the total match count in X-Total-Count on the first page.
+    """
+    if sort_by not in ORDER_SORT_FIELDS or sort_order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Invalid sort")
+
+    query = {}
+    if status:
+        query["status"] = {"$in": [st.strip() for st in status.split(",") if st.strip()]}
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = date_from
+        if date_to:
+            query["created_at"]["$lte"] = date_to
+    if min_amount is not None or max_amount is not None:
+        query["total_amount"] = {}
+        if min_amount is not None:
+            query["total_amount"]["$gte"] = min_amount
+        if max_amount is not None:
+            query["total_amount"]["$lte"] = max_amount
+    if item_type:
+        query["items.type"] = item_type
+    user_ids = [user_id] if user_id else None
+    if phone:
+        # Short prefixes match a large share of users, every one of them goes into $in
+        prefix = normalize_phone_prefix(phone)
+        national = prefix[len("+380"):] if prefix.startswith("+380") else prefix[1:]
+        if len(national) < PHONE_SEARCH_MIN_DIGITS:
+            raise HTTPException(status_code=400, detail=f"Phone filter needs at least {PHONE_SEARCH_MIN_DIGITS} digits after the country code")
+        users = await db.users.find(
+            {"phone": {"$regex": f"^{re.escape(prefix)}"}}, {"_id": 0, "id": 1}
+        ).to_list(PHONE_SEARCH_MAX_USERS + 1)
+        if len(users) > PHONE_SEARCH_MAX_USERS:
+            raise HTTPException(status_code=400, detail="Phone filter matches too many users, enter more digits")
+        phone_ids = [u["id"] for u in users]
+        user_ids = [uid for uid in user_ids if uid in phone_ids] if user_ids else phone_ids
+    if user_ids is not None:
+        query["user_id"] = {"$in": user_ids}
+
+    direction = -1 if sort_order == "desc" else 1
+    page_query = query
+    if cursor:
+        value, last_id = decode_order_cursor(cursor, sort_by)
+        after = "$lt" if direction < 0 else "$gt"
+        page_query = {"$and": [query, {"$or": [
+            {sort_by: {after: value}},
+            {sort_by: value, "id": {after: last_id}},
+        ]}]}
+
+    find = db.orders.find(page_query).sort([(sort_by, direction), ("id", direction)]).to_list(limit + 1)
+    if cursor:
+        orders = await find
+    else:
+        orders, total = await asyncio.gather(find, db.orders.count_documents(query))
+        response.headers["X-Total-Count"] = str(total)
+
+    result = [Order(**o) for o in orders[:limit]]
+    if len(orders) > limit:
+        response.headers["X-Next-Cursor"] = encode_order_cursor(result[-1], sort_by)
+    return result
 
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
@@ -678,17 +2249,309 @@ async def get_order(order_id: str):
 
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str):
-    result = await db.orders.update_one({"id": order_id}, {"$set": {"status": status}})
-    if result.modified_count == 0:
+    # The previous status decides whether user stats have to be reversed or re-applied
+    previous = await db.orders.find_one_and_update(
+        {"id": order_id},
+        {"$set": {"status": status, "updated_at": datetime.utcnow()}},
+        projection=ORDER_STATS_PROJECTION
+    )
+    if not previous:
         raise HTTPException(status_code=404, detail="Order not found")
+    await apply_user_stat_deltas(status_change_deltas([previous], status))
+    await update_summary_order_status([order_id], status)
     return {"message": "Order status updated"}
 
+# ===================== USER STATS =====================
+
+# Orders in these statuses do not count towards user totals
+UNCOUNTED_ORDER_STATUSES = ["cancelled", "refunded"]
+
+ORDER_STATS_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "status": 1, "total_amount": 1, "bonus_points_earned": 1}
+
+def order_counts(status: str) -> bool:
+    return status not in UNCOUNTED_ORDER_STATUSES
+
+async def get_cached_loyalty_rules() -> List[dict]:
+    """Loyalty rules sorted by min_total_amount descending, cached for a short while"""
+    rules = loyalty_rules_cache.get("rules")
+    if rules is None:
+        rules = await db.loyalty_rules.find({}, {"_id": 0}).sort("min_total_amount", -1).to_list(100)
+        loyalty_rules_cache.set("rules", rules)
+    return rules
+
+def order_summary(order: Order) -> dict:
+    """Compact order entry kept in users.recent_orders for the profile summary"""
+    return {
+        "id": order.id,
+        "created_at": order.created_at,
+        "total_amount": order.total_amount,
+        "status": order.status,
+        "items_count": sum(item.quantity for item in order.items),
+        "bonus_points_earned": order.bonus_points_earned,
+    }
+
+async def update_summary_order_status(order_ids: List[str], status: str):
+    await db.users.update_many(
+        {"recent_orders.id": {"$in": order_ids}},
+        {"$set": {"recent_orders.$[o].status": status}},
+        array_filters=[{"o.id": {"$in": order_ids}}]
+    )
+
+def find_loyalty_rule(total: float, rules: List[dict]) -> Optional[dict]:
+    """Highest tier reached by total, rules must be sorted by min_total_amount descending"""
+    for rule in rules:
+        if total >= rule.get("min_total_amount", 0):
+            return rule
+    return None
+
+def status_change_deltas(orders: List[dict], new_status: str) -> dict:
+    """Per-user $inc amounts for orders moving into or out of the counted statuses"""
+    deltas = {}
+    for order in orders:
+        was_counted = order_counts(order.get("status", "pending"))
+        if was_counted == order_counts(new_status):
+            continue
+        sign = 1 if not was_counted else -1
+        delta = deltas.setdefault(
+            order["user_id"], {"total_orders_count": 0, "total_orders_amount": 0, "bonus_points": 0}
+        )
+        delta["total_orders_count"] += sign
+        delta["total_orders_amount"] += sign * order.get("total_amount", 0)
+        delta["bonus_points"] += sign * order.get("bonus_points_earned", 0)
+    return deltas
+
+async def apply_user_stat_deltas(deltas: dict):
+    """Apply per-user stat changes, then move affected users to their new loyalty tier"""
+    if not deltas:
+        return
+    await db.users.bulk_write(
+        [UpdateOne({"id": user_id}, {"$inc": delta}) for user_id, delta in deltas.items()],
+        ordered=False
+    )
+    rules = await get_cached_loyalty_rules()
+    users = await db.users.find(
+        {"id": {"$in": list(deltas)}},
+        {"_id": 0, "id": 1, "total_orders_amount": 1, "discount_percent": 1, "qr_md5": 1}
+    ).to_list(None)
+    tier_updates = []
+    for user in users:
+        card_cache.pop(user.get("qr_md5", ""))
+        rule = find_loyalty_rule(user.get("total_orders_amount", 0), rules)
+        if rule and rule.get("discount_percent", 0) != user.get("discount_percent", 0):
+            tier_updates.append(
+                UpdateOne({"id": user["id"]}, {"$set": {"discount_percent": rule.get("discount_percent", 0)}})
+            )
+    if tier_updates:
+        await db.users.bulk_write(tier_updates, ordered=False)
+
+async def reconcile_user_stats(dry_run: bool = False) -> dict:
+    """Recompute user totals from orders and correct drifted users in chunked bulk writes
+
+    The per-user aggregation and the users collection are both streamed sorted by id
+    and merge-joined, so memory stays flat regardless of the number of orders.
+    """
+    rules = await db.loyalty_rules.find().sort("min_total_amount", -1).to_list(100)
+    pipeline = [
+        {"$match": {"status": {"$nin": UNCOUNTED_ORDER_STATUSES}}},
+        {"$group": {
+            "_id": "$user_id",
+            "total_orders_count": {"$sum": 1},
+            "total_orders_amount": {"$sum": "$total_amount"},
+            "bonus_points": {"$sum": "$bonus_points_earned"},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    totals_cursor = db.orders.aggregate(pipeline, allowDiskUse=True)
+    users_cursor = db.users.find(
+        {},
+        {"_id": 0, "id": 1, "qr_md5": 1, "discount_percent": 1,
+         "total_orders_count": 1, "total_orders_amount": 1, "bonus_points": 1}
+    ).sort("id", 1)
+
+    report = {
+        "users_checked": 0,
+        "users_corrected": 0,
+        # Changed by an order write after they were read, left for the next run
+        "users_skipped": 0,
+        "drift": {"total_orders_count": 0, "total_orders_amount": 0.0, "bonus_points": 0},
+        "samples": [],
+        "dry_run": dry_run,
+    }
+    pending = []
+    totals = await anext(totals_cursor, None)
+
+    async def flush():
+        if pending and not dry_run:
+            result = await db.users.bulk_write(pending, ordered=False)
+            report["users_corrected"] += result.matched_count
+            report["users_skipped"] += len(pending) - result.matched_count
+        elif pending:
+            report["users_corrected"] += len(pending)
+        pending.clear()
+
+    async for user in users_cursor:
+        report["users_checked"] += 1
+        while totals is not None and totals["_id"] < user["id"]:
+            totals = await anext(totals_cursor, None)
+        expected = {"total_orders_count": 0, "total_orders_amount": 0, "bonus_points": 0}
+        if totals is not None and totals["_id"] == user["id"]:
+            expected = {k: totals[k] for k in expected}
+
+        changes = {}
+        for field, value in expected.items():
+            current = user.get(field, 0)
+            if abs(current - value) > 0.005:
+                changes[field] = value
+                report["drift"][field] += value - current
+        rule = find_loyalty_rule(expected["total_orders_amount"], rules)
+        if rule and rule.get("discount_percent", 0) != user.get("discount_percent", 0):
+            changes["discount_percent"] = rule.get("discount_percent", 0)
+        if not changes:
+            continue
+
+        if len(report["samples"]) < 20:
+            report["samples"].append({"user_id": user["id"], "changes": changes})
+        card_cache.pop(user.get("qr_md5", ""))
+        # Only apply to the values read, an order $inc landing in between must not be overwritten
+        read_filter = {"id": user["id"]}
+        for field in expected:
+            read_filter[field] = user[field] if field in user else {"$exists": False}
+        pending.append(UpdateOne(read_filter, {"$set": changes}))
+        if len(pending) >= USER_STATS_RECONCILE_CHUNK_SIZE:
+            await flush()
+    await flush()
+    return report
+
+async def run_user_stats_reconciliation():
+    while True:
+        await asyncio.sleep(USER_STATS_RECONCILE_INTERVAL_SECONDS)
+        try:
+            report = await reconcile_user_stats()
+            if report["users_corrected"]:
+                logger.warning("User stats drift corrected: %s", report)
+        except Exception as e:
+            logger.error("User stats reconciliation failed: %s", e)
+
+@api_router.post("/admin/users/reconcile-stats")
+async def trigger_user_stats_reconciliation(dry_run: bool = False):
+    """Recompute user aggregates from orders, report the drift found"""
+    return await reconcile_user_stats(dry_run=dry_run)
+
+# ===================== BULK ADMIN OPERATIONS =====================
+
+def build_bulk_query(bulk_filter: BulkFilter) -> dict:
+    query = {}
+    if bulk_filter.ids is not None:
+        query["id"] = {"$in": bulk_filter.ids}
+    if bulk_filter.catalog_id:
+        query["catalog_id"] = bulk_filter.catalog_id
+    if bulk_filter.is_visible is not None:
+        query["is_visible"] = bulk_filter.is_visible
+    if not query:
+        # Refuse to touch the whole collection by accident
+        raise HTTPException(status_code=400, detail="Filter is required")
+    return query
+
+async def apply_bulk_update(collection, query: dict, bulk_update: BaseModel) -> dict:
+    data = {k: v for k, v in bulk_update.dict(exclude={"filter"}).items() if v is not None}
+    price_change = data.pop("price_change_percent", None)
+    if price_change is not None and "price_uah" in data:
+        raise HTTPException(status_code=400, detail="Use either price_uah or price_change_percent")
+    if not data and price_change is None:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    data["updated_at"] = datetime.utcnow()
+    if price_change is None:
+        result = await collection.update_many(query, {"$set": data})
+        return {"matched": result.matched_count, "modified": result.modified_count}
+    
+    # Prices are computed here and rounded to kopiyky, $mul leaves float artifacts.
+    # Each write is conditional on the price read, a concurrent edit is not overwritten.
+    factor = 1 + price_change / 100
+    docs = await collection.find(query, {"_id": 0, "id": 1, "price_uah": 1}).to_list(None)
+    ops = [
+        UpdateOne(
+            {"id": d["id"], "price_uah": d["price_uah"]},
+            {"$set": {**data, "price_uah": round(d["price_uah"] * factor, 2)}}
+        )
+        for d in docs if isinstance(d.get("price_uah"), (int, float))
+    ]
+    if not ops:
+        return {"matched": 0, "modified": 0}
+    result = await collection.bulk_write(ops, ordered=False)
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+@api_router.post("/admin/products/bulk-update")
+async def bulk_update_products(bulk_update: ProductBulkUpdate):
+    """Update visibility, price or discount of all matching products at once"""
+    result = await apply_bulk_update(db.products, build_bulk_query(bulk_update.filter), bulk_update)
+    read_coalescer.invalidate()
+    return result
+
+@api_router.post("/admin/products/bulk-delete")
+async def bulk_delete_products(bulk_delete: BulkDelete):
+    result = await db.products.delete_many(build_bulk_query(bulk_delete.filter))
+    read_coalescer.invalidate()
+    return {"deleted": result.deleted_count}
+
+@api_router.post("/admin/services/bulk-update")
+async def bulk_update_services(bulk_update: ServiceBulkUpdate):
+    """Update visibility or price of all matching services at once"""
+    result = await apply_bulk_update(db.services, build_bulk_query(bulk_update.filter), bulk_update)
+    read_coalescer.invalidate()
+    return result
+
+@api_router.post("/admin/services/bulk-delete")
+async def bulk_delete_services(bulk_delete: BulkDelete):
+    services = await db.services.find(build_bulk_query(bulk_delete.filter), {"_id": 0, "id": 1}).to_list(None)
+    service_ids = [srv["id"] for srv in services]
+    # Unlink first, like cascade_catalog, so masters never point at a deleted service
+    masters_updated = await pull_service_links(service_ids)
+    result = await db.services.delete_many({"id": {"$in": service_ids}})
+    read_coalescer.invalidate()
+    return {"deleted": result.deleted_count, "masters_updated": masters_updated}
+
+@api_router.post("/admin/orders/bulk-status")
+async def bulk_update_order_status(bulk_update: OrderBulkStatusUpdate):
+    """Move many orders to a new status in one update"""
+    query = {"id": {"$in": bulk_update.order_ids}, "status": {"$ne": bulk_update.status}}
+    if bulk_update.from_statuses is not None:
+        query["status"] = {"$in": [st for st in bulk_update.from_statuses if st != bulk_update.status]}
+    orders = await db.orders.find(query, ORDER_STATS_PROJECTION).to_list(None)
+    if not orders:
+        return {"matched": 0, "modified": 0}
+    query["id"] = {"$in": [o["id"] for o in orders]}
+    result = await db.orders.update_many(
+        query,
+        {"$set": {"status": bulk_update.status, "updated_at": datetime.utcnow()}}
+    )
+    if result.modified_count != len(orders):
+        # Concurrent status change, the periodic reconciliation repairs the stats
+        logger.warning("Bulk status update changed %d of %d orders", result.modified_count, len(orders))
+    await apply_user_stat_deltas(status_change_deltas(orders, bulk_update.status))
+    await update_summary_order_status([o["id"] for o in orders], bulk_update.status)
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+@api_router.post("/admin/orders/bulk-delete")
+async def bulk_delete_orders(bulk_delete: OrderBulkDelete):
+    query = {"id": {"$in": bulk_delete.order_ids}}
+    orders = await db.orders.find(query, ORDER_STATS_PROJECTION).to_list(None)
+    result = await db.orders.delete_many(query)
+    # Deleted orders stop counting, same as a cancellation
+    await apply_user_stat_deltas(status_change_deltas(orders, UNCOUNTED_ORDER_STATUSES[0]))
+    await db.users.update_many(
+        {"recent_orders.id": {"$in": bulk_delete.order_ids}},
+        {"$pull": {"recent_orders": {"id": {"$in": bulk_delete.order_ids}}}}
+    )
+    return {"deleted": result.deleted_count}
+
 # ===================== LOYALTY RULES =====================
 
 @api_router.post("/loyalty-rules", response_model=LoyaltyRule)
 async def create_loyalty_rule(rule: LoyaltyRuleCreate):
     rule_obj = LoyaltyRule(**rule.dict())
     await db.loyalty_rules.insert_one(rule_obj.dict())
+    loyalty_rules_cache.clear()
+    read_coalescer.invalidate()
     return rule_obj
 
 @api_router.get("/loyalty-rules", response_model=List[LoyaltyRule])
@@ -702,6 +2565,8 @@ async def update_loyalty_rule(rule_id: str, rule: LoyaltyRuleCreate):
     result = await db.loyalty_rules.update_one({"id": rule_id}, {"$set": update_data})
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Rule not found")
+    loyalty_rules_cache.clear()
+    read_coalescer.invalidate()
     updated = await db.loyalty_rules.find_one({"id": rule_id})
     return LoyaltyRule(**updated)
 
@@ -710,6 +2575,8 @@ async def delete_loyalty_rule(rule_id: str):
     result = await db.loyalty_rules.delete_one({"id": rule_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Rule not found")
+    loyalty_rules_cache.clear()
+    read_coalescer.invalidate()
     return {"message": "Rule deleted"}
 
 # ===================== SETTINGS =====================
@@ -763,9 +2630,10 @@ async def check_if_admin(phone: str):
         settings.get("admin_phone3", "")
     ]
     
-    # Remove empty strings and check if phone matches
-    admin_phones = [p for p in admin_phones if p]
-    is_admin = phone in admin_phones
+    # Remove empty strings and check if phone matches in canonical form
+    phone = normalize_phone(phone)
+    admin_phones = [normalize_phone(p) for p in admin_phones if p]
+    is_admin = bool(phone) and phone in admin_phones
     
     return {"is_admin": is_admin}
 
@@ -786,7 +2654,8 @@ async def test_server_connection(server_address: str, access_code: str):
             if access_code:
                 headers['Authorization'] = f'Bearer {access_code}'
             
-            response = await client.get(f"{server_url}/api/", headers=headers)
+            with profile_span("http"):
+                response = await client.get(f"{server_url}/api/", headers=headers)
             
             if response.status_code == 200:
                 return {
@@ -847,10 +2716,56 @@ async def send_telegram_notification(order: Order, user: User):
     try:
         async with httpx.AsyncClient() as client:
             url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-            await client.post(url, json={"chat_id": chat_id, "text": message, "parse_mode": "HTML"})
-            logger.info(f"Telegram notification sent for order {order.id}")
+            with profile_span("http"):
+                await client.post(url, json={"chat_id": chat_id, "text": message, "parse_mode": "HTML"})
+            logger.info("Telegram notification sent for order %s", order.id)
     except Exception as e:
-        logger.error(f"Failed to send Telegram notification: {e}")
+        logger.error("Failed to send Telegram notification: %s", e)
+
+# ===================== METRICS =====================
+
+@api_router.get("/admin/metrics/coalescing")
+async def get_coalescing_metrics():
+    """Counters of the read coalescing layer"""
+    return {
+        **read_coalescer.stats,
+        "in_flight": len(read_coalescer._inflight),
+        "cache_seconds": read_coalescer.cache_seconds,
+    }
+
+@api_router.get("/admin/metrics/logging")
+async def get_logging_metrics():
+    """Backlog of the logging queue and records dropped under load"""
+    handler = log_pipeline.handler
+    if handler is None:
+        return {"installed": False}
+    return {
+        "installed": True,
+        "queued": handler.queue.qsize(),
+        "capacity": LOG_QUEUE_SIZE,
+        "soft_limit": handler.soft_limit,
+        "dropped": handler.dropped,
+    }
+
+@api_router.get("/admin/profiles")
+async def get_profiles():
+    """Recent request profiles, newest first"""
+    return [p.summary() for p in reversed(current_app_state.get().profiler.profiles)]
+
+@api_router.get("/admin/profiles/collapsed")
+async def get_profiles_collapsed():
+    """All recent profiles in collapsed-stack format, rooted at the endpoint, for flamegraph tools"""
+    lines = []
+    for profile in current_app_state.get().profiler.profiles:
+        lines.extend(profile.collapsed(prefix=f"{profile.method} {profile.path};"))
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain")
+
+@api_router.get("/admin/profiles/{profile_id}/collapsed")
+async def get_profile_collapsed(profile_id: str):
+    profile = current_app_state.get().profiler.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(content="\n".join(profile.collapsed()) + "\n", media_type="text/plain")
 
 # ===================== SEED DATA =====================
 
@@ -990,20 +2905,145 @@ async def seed_demo_data():
     ]
     for r in loyalty_rules:
         await db.loyalty_rules.insert_one(r.dict())
+    loyalty_rules_cache.clear()
     
+    read_coalescer.invalidate()
     return {"message": "Demo data created successfully"}
 
-# Include the router in the main app
-app.include_router(api_router)
+# ===================== APP FACTORY =====================
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def open_storage():
+    state = current_app_state.get()
+    if state.storage is None:
+        state.storage = build_storage(state.config)
+
+async def close_storage():
+    current_app_state.get().storage.close()
+
+async def ensure_index(collection, keys, **kwargs):
+    try:
+        await collection.create_index(keys, **kwargs)
+    except OperationFailure as e:
+        # IndexOptionsConflict: the TTL changed since the index was built
+        if e.code == 85 and "expireAfterSeconds" in kwargs:
+            await db.command(
+                "collMod", collection.name,
+                index={"keyPattern": {keys: 1} if isinstance(keys, str) else dict(keys),
+                       "expireAfterSeconds": kwargs["expireAfterSeconds"]}
+            )
+        # The index became unique since it was built, unique cannot be changed in place
+        elif e.code in (85, 86) and kwargs.get("unique"):
+            fields = [(keys, 1)] if isinstance(keys, str) else keys
+            await collection.drop_index("_".join(f"{field}_{direction}" for field, direction in fields))
+            await ensure_index(collection, keys, **kwargs)
+        else:
+            logger.error("Failed to create index %s on %s: %s", keys, collection.name, e)
+    except Exception as e:
+        logger.error("Failed to create index %s on %s: %s", keys, collection.name, e)
+
+async def create_indexes():
+    await ensure_index(
+        db.users, "qr_md5",
+        unique=True,
+        partialFilterExpression={"qr_md5": {"$gt": ""}}
+    )
+    await ensure_index(db.carts, "user_id", unique=True)
+    if CART_TTL_DAYS > 0:
+        await ensure_index(db.carts, "updated_at", expireAfterSeconds=int(CART_TTL_DAYS * 86400))
+    await ensure_index(db.products, "catalog_id")
+    await ensure_index(db.services, "catalog_id")
+    await ensure_index(db.masters, "service_ids")
+    # Joined master/service reads match and $lookup on these
+    await ensure_index(db.services, "id", unique=True)
+    await ensure_index(db.masters, "id", unique=True)
+    await ensure_index(db.cascade_jobs, "status")
+    await ensure_index(db.users, "id", unique=True)
+    await ensure_index(db.migrations, "id", unique=True)
+    # Phones have to be canonical and unique before the unique index can be built,
+    # the merge runs once, later boots only see its marker
+    try:
+        report = await run_migration("merge_duplicate_users", merge_duplicate_users)
+        if report and (report["users_merged"] or report["phones_normalized"]):
+            logger.warning("Merged duplicate users: %s", report)
+    except Exception as e:
+        logger.error("Merging duplicate users failed: %s", e)
+    await ensure_index(
+        db.users, "phone",
+        unique=True,
+        partialFilterExpression={"phone": {"$gt": ""}}
+    )
+    # Admin order filters, each one followed by the default created_at sort
+    # An idempotent retry reuses the order id of the submission it took over
+    await ensure_index(db.orders, "id", unique=True)
+    await ensure_index(db.orders, [("created_at", -1), ("id", -1)])
+    await ensure_index(db.orders, [("status", 1), ("created_at", -1), ("id", -1)])
+    await ensure_index(db.orders, [("user_id", 1), ("created_at", -1), ("id", -1)])
+    await ensure_index(db.orders, [("items.type", 1), ("created_at", -1), ("id", -1)])
+    await ensure_index(db.orders, [("total_amount", -1), ("id", -1)])
+    await ensure_index(db.idempotency_keys, [("user_id", 1), ("key", 1)], unique=True)
+    await ensure_index(db.idempotency_keys, "created_at", expireAfterSeconds=int(IDEMPOTENCY_KEY_TTL_HOURS * 3600))
+
+def spawn_background(coro):
+    # Keep a reference so the task is not garbage collected mid-run
+    background_tasks = current_app_state.get().background_tasks
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def start_background_jobs():
+    if not current_app_state.get().config.background_jobs:
+        return
+    spawn_background(resume_cascade_jobs())
+    spawn_background(run_cart_compaction())
+    spawn_background(run_integrity_checks())
+    spawn_background(run_user_stats_reconciliation())
+
+def bind_state(state: AppState, handler):
+    async def run():
+        token = current_app_state.set(state)
+        try:
+            await handler()
+        finally:
+            current_app_state.reset(token)
+    return run
+
+async def stop_background_jobs():
+    for task in list(current_app_state.get().background_tasks):
+        task.cancel()
+
+def create_app(config: Optional[AppConfig] = None, storage: Optional[Storage] = None) -> FastAPI:
+    """Build an app instance, storage is opened on startup unless one is passed in"""
+    state = AppState(config or AppConfig.from_env(), storage)
+    app = FastAPI(title="Shooting Range API")
+    app.state.shooting_range = state
+
+    # Include the router in the main app
+    app.include_router(api_router)
+
+    app.add_middleware(CompressionMiddleware)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "X-Total-Count", "X-Profile-Id", "X-Request-ID"],
+    )
+
+    # Outside compression so its cost shows up in the profile
+    app.add_middleware(ProfilingMiddleware)
+
+    app.add_middleware(RequestLogMiddleware)
+
+    # Outermost, so every other layer sees this app's state
+    app.add_middleware(AppStateMiddleware, state=state)
+
+    for handler in (start_logging, open_storage, create_indexes, start_background_jobs):
+        app.add_event_handler("startup", bind_state(state, handler))
+    for handler in (stop_background_jobs, close_storage, stop_logging):
+        app.add_event_handler("shutdown", bind_state(state, handler))
+    return app
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+app = create_app()
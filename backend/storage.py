@@ -0,0 +1,837 @@
+import abc
+import copy
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+# Collections used by the API, every storage backend exposes them as attributes
+COLLECTIONS = (
+    "catalogs", "products", "services", "masters", "users", "carts", "orders",
+    "loyalty_rules", "settings", "cascade_jobs", "idempotency_keys", "migrations",
+)
+
+
+class Storage(abc.ABC):
+    """Storage backend: collections with the Motor collection API plus command/close"""
+
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+
+    @abc.abstractmethod
+    async def command(self, *args, **kwargs) -> dict:
+        """Run a database command such as collMod"""
+
+    def close(self):
+        pass
+
+
+class MotorStorage(Storage):
+    """MongoDB through Motor, the client connects lazily on first use"""
+
+    def __init__(self, mongo_url: str, db_name: str):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        self.client = AsyncIOMotorClient(mongo_url)
+        self.db = self.client[db_name]
+
+    def __getattr__(self, name: str):
+        # Any collection, including ones added later than COLLECTIONS
+        if name.startswith("_") or name in ("client", "db"):
+            raise AttributeError(name)
+        return self.db[name]
+
+    async def command(self, *args, **kwargs) -> dict:
+        return await self.db.command(*args, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStorage(Storage):
+    """In-process storage for tests and benchmarks, nothing is persisted"""
+
+    def __init__(self):
+        self._collections: Dict[str, MemoryCollection] = {}
+        for name in COLLECTIONS:
+            self._collections[name] = MemoryCollection(name, self)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name, self)
+        return self._collections[name]
+
+    async def command(self, *args, **kwargs) -> dict:
+        # collMod and friends only tune indexes, nothing to do in memory
+        return {"ok": 1.0}
+
+
+# ===================== QUERY EVALUATION =====================
+
+_MISSING = object()
+
+
+def _lookup(value, parts: List[str]) -> list:
+    """All values reachable by a dotted path, descending into arrays like MongoDB"""
+    if not parts:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if head in value:
+            return _lookup(value[head], rest)
+        return []
+    if isinstance(value, list):
+        if head.isdigit():
+            index = int(head)
+            return _lookup(value[index], rest) if index < len(value) else []
+        found = []
+        for item in value:
+            if isinstance(item, (dict, list)):
+                found.extend(_lookup(item, parts))
+        return found
+    return []
+
+
+def get_values(doc: dict, path: str) -> list:
+    return _lookup(doc, path.split("."))
+
+
+def get_value(doc: dict, path: str, default=None):
+    values = get_values(doc, path)
+    return values[0] if values else default
+
+
+def _expand(values: list) -> list:
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _equals(values: list, target) -> bool:
+    if target is None:
+        return not values or any(v is None for v in values)
+    if isinstance(target, re.Pattern):
+        return any(isinstance(v, str) and target.search(v) for v in _expand(values))
+    return any(v == target or (isinstance(v, list) and target in v) for v in values)
+
+
+def _compare(values: list, target, op) -> bool:
+    for value in _expand(values):
+        try:
+            if value is not None and op(value, target):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _match_operators(values: list, operators: dict) -> bool:
+    for op, target in operators.items():
+        if op == "$eq":
+            ok = _equals(values, target)
+        elif op == "$ne":
+            ok = not _equals(values, target)
+        elif op == "$in":
+            ok = any(_equals(values, t) for t in target)
+        elif op == "$nin":
+            ok = not any(_equals(values, t) for t in target)
+        elif op == "$gt":
+            ok = _compare(values, target, lambda a, b: a > b)
+        elif op == "$gte":
+            ok = _compare(values, target, lambda a, b: a >= b)
+        elif op == "$lt":
+            ok = _compare(values, target, lambda a, b: a < b)
+        elif op == "$lte":
+            ok = _compare(values, target, lambda a, b: a <= b)
+        elif op == "$exists":
+            ok = bool(values) == bool(target)
+        elif op == "$size":
+            ok = any(isinstance(v, list) and len(v) == target for v in values)
+        elif op == "$regex":
+            flags = re.IGNORECASE if "i" in operators.get("$options", "") else 0
+            pattern = target if isinstance(target, re.Pattern) else re.compile(target, flags)
+            ok = any(isinstance(v, str) and pattern.search(v) for v in _expand(values))
+        elif op == "$options":
+            ok = True
+        elif op == "$not":
+            ok = not _match_operators(values, target)
+        elif op == "$elemMatch":
+            ok = any(
+                isinstance(v, list) and any(isinstance(e, dict) and match(e, target) for e in v)
+                for v in values
+            )
+        else:
+            raise OperationFailure(f"Unsupported query operator {op}")
+        if not ok:
+            return False
+    return True
+
+
+def _is_operator_dict(value) -> bool:
+    return isinstance(value, dict) and bool(value) and all(k.startswith("$") for k in value)
+
+
+def match(doc: dict, query: Optional[dict]) -> bool:
+    """True if doc satisfies a MongoDB filter document"""
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            ok = any(match(doc, q) for q in condition)
+        elif key == "$and":
+            ok = all(match(doc, q) for q in condition)
+        elif key == "$nor":
+            ok = not any(match(doc, q) for q in condition)
+        elif key == "$expr":
+            ok = bool(evaluate(condition, doc))
+        elif _is_operator_dict(condition):
+            ok = _match_operators(get_values(doc, key), condition)
+        else:
+            ok = _equals(get_values(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def evaluate(expr, doc: dict):
+    """Evaluate an aggregation expression against a document"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        return get_value(doc, expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc) for e in expr]
+    if not _is_operator_dict(expr):
+        if isinstance(expr, dict):
+            return {k: evaluate(v, doc) for k, v in expr.items()}
+        return expr
+    op, args = next(iter(expr.items()))
+    if op == "$literal":
+        return args
+    values = evaluate(args, doc) if isinstance(args, list) else [evaluate(args, doc)]
+    if op == "$ifNull":
+        return next((v for v in values if v is not None), None)
+    if op in ("$eq", "$ne", "$lt", "$lte", "$gt", "$gte"):
+        a, b = values
+        if op == "$eq":
+            return a == b
+        if op == "$ne":
+            return a != b
+        try:
+            if op == "$lt":
+                return a < b
+            if op == "$lte":
+                return a <= b
+            if op == "$gt":
+                return a > b
+            return a >= b
+        except TypeError:
+            return False
+    if op == "$and":
+        return all(values)
+    if op == "$or":
+        return any(values)
+    if op == "$not":
+        return not values[0]
+    if op == "$add":
+        return sum(v or 0 for v in values)
+    if op == "$subtract":
+        return (values[0] or 0) - (values[1] or 0)
+    if op == "$multiply":
+        result = 1
+        for v in values:
+            result *= v or 0
+        return result
+    if op == "$size":
+        return len(values[0] or [])
+    if op == "$cond":
+        if isinstance(args, dict):
+            values = [evaluate(args["if"], doc), evaluate(args["then"], doc), evaluate(args["else"], doc)]
+        return values[1] if values[0] else values[2]
+    if op == "$in":
+        return values[0] in (values[1] or [])
+    if op == "$slice":
+        array, count = values[0] or [], values[1]
+        return array[:count] if count >= 0 else array[count:]
+    raise OperationFailure(f"Unsupported expression operator {op}")
+
+
+def _sort_key(value):
+    # Missing/None sort first, like MongoDB
+    return (0, 0) if value is None else (1, value)
+
+
+def sort_documents(docs: list, spec) -> list:
+    if isinstance(spec, str):
+        spec = [(spec, 1)]
+    elif isinstance(spec, dict):
+        spec = list(spec.items())
+    for key, direction in reversed(list(spec)):
+        docs.sort(key=lambda d: _sort_key(get_value(d, key)), reverse=direction < 0)
+    return docs
+
+
+def project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        result = {k: doc[k] for k in doc if k in include}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+# ===================== UPDATES =====================
+
+def _set_path(doc: dict, path: str, value):
+    parts = path.split(".")
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _unset_path(doc: dict, path: str):
+    parts = path.split(".")
+    target = doc
+    for part in parts[:-1]:
+        target = target.get(part) if isinstance(target, dict) else None
+        if target is None:
+            return
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+
+
+def _pull_matches(element, condition) -> bool:
+    if _is_operator_dict(condition):
+        return _match_operators([element], condition)
+    if isinstance(condition, dict) and isinstance(element, dict):
+        return match(element, condition)
+    return element == condition
+
+
+def _group_array_filters(array_filters: Optional[List[dict]]) -> Dict[str, dict]:
+    grouped: Dict[str, dict] = {}
+    for array_filter in array_filters or []:
+        for key, condition in array_filter.items():
+            grouped.setdefault(key.split(".")[0], {})[key] = condition
+    return grouped
+
+
+def _resolve_paths(doc: dict, parts: List[str], filters: Dict[str, dict], prefix: List[str]) -> List[str]:
+    """Expand $[] and $[ident] segments into concrete dotted paths"""
+    if not parts:
+        return [".".join(prefix)]
+    head, rest = parts[0], parts[1:]
+    if head.startswith("$[") and head.endswith("]"):
+        ident = head[2:-1]
+        array = get_value(doc, ".".join(prefix)) if prefix else None
+        paths = []
+        for index, element in enumerate(array if isinstance(array, list) else []):
+            if not ident or match({ident: element}, filters.get(ident, {})):
+                paths.extend(_resolve_paths(doc, rest, filters, prefix + [str(index)]))
+        return paths
+    return _resolve_paths(doc, rest, filters, prefix + [head])
+
+
+def apply_update(doc: dict, update: dict, inserting: bool = False, array_filters: Optional[List[dict]] = None):
+    if not any(k.startswith("$") for k in update):
+        # Replacement document
+        preserved_id = doc.get("_id")
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if preserved_id is not None:
+            doc["_id"] = preserved_id
+        return
+    filters = _group_array_filters(array_filters)
+    for op, fields in update.items():
+        for field_path, field_value in fields.items():
+            paths = [field_path]
+            if "$[" in field_path:
+                paths = _resolve_paths(doc, field_path.split("."), filters, [])
+            for path in paths:
+                _apply_operator(doc, op, path, copy.deepcopy(field_value), inserting)
+
+
+def _apply_operator(doc: dict, op: str, path: str, value, inserting: bool):
+    current = get_value(doc, path, _MISSING)
+    if op == "$set":
+        _set_path(doc, path, value)
+    elif op == "$setOnInsert":
+        if inserting:
+            _set_path(doc, path, value)
+    elif op == "$unset":
+        _unset_path(doc, path)
+    elif op == "$inc":
+        _set_path(doc, path, (0 if current is _MISSING else current) + value)
+    elif op == "$mul":
+        _set_path(doc, path, (0 if current is _MISSING else current) * value)
+    elif op == "$max":
+        if current is _MISSING or value > current:
+            _set_path(doc, path, value)
+    elif op == "$min":
+        if current is _MISSING or value < current:
+            _set_path(doc, path, value)
+    elif op in ("$push", "$addToSet"):
+        array = [] if current is _MISSING else list(current)
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        position = value.get("$position", len(array)) if isinstance(value, dict) else len(array)
+        for item in items:
+            if op == "$push" or item not in array:
+                array.insert(position, item)
+                position += 1
+        if isinstance(value, dict) and "$slice" in value:
+            count = value["$slice"]
+            array = array[:count] if count >= 0 else array[count:]
+        _set_path(doc, path, array)
+    elif op == "$pull":
+        if current is not _MISSING:
+            _set_path(doc, path, [e for e in current if not _pull_matches(e, value)])
+    else:
+        raise OperationFailure(f"Unsupported update operator {op}")
+
+
+def _upsert_seed(query: dict) -> dict:
+    """Equality parts of a filter become fields of an upserted document"""
+    doc = {}
+    for key, condition in query.items():
+        if key.startswith("$"):
+            continue
+        if _is_operator_dict(condition):
+            if "$eq" in condition:
+                _set_path(doc, key, copy.deepcopy(condition["$eq"]))
+            continue
+        _set_path(doc, key, copy.deepcopy(condition))
+    return doc
+
+
+# ===================== CURSORS =====================
+
+class MemoryCursor:
+    """Lazily evaluated result set with the Motor cursor API used by the server"""
+
+    def __init__(self, produce):
+        self._produce = produce
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+        self._iter = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def _evaluate(self) -> list:
+        if self._results is None:
+            docs = self._produce()
+            if self._sort:
+                docs = sort_documents(docs, self._sort)
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            self._results = docs
+        return self._results
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        docs = self._evaluate()
+        return list(docs if length is None else docs[:length])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iter is None:
+            self._iter = iter(self._evaluate())
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+# ===================== COLLECTION =====================
+
+class MemoryCollection:
+    """Subset of the Motor collection API backed by a list of dicts"""
+
+    def __init__(self, name: str, storage: MemoryStorage):
+        self.name = name
+        self._storage = storage
+        self._docs: List[dict] = []
+        self._indexes: Dict[str, dict] = {}
+
+    # ----- indexes -----
+
+    async def create_index(self, keys, unique: bool = False, name: Optional[str] = None, **kwargs) -> str:
+        fields = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        index_name = name or "_".join(f"{field}_{direction}" for field, direction in fields)
+        existing = self._indexes.get(index_name)
+        spec = {
+            "fields": [field for field, _ in fields],
+            "unique": unique,
+            "partial": kwargs.get("partialFilterExpression"),
+            "ttl": kwargs.get("expireAfterSeconds"),
+        }
+        if existing and existing != spec:
+            raise OperationFailure(f"Index {index_name} already exists with different options", code=85)
+        if unique:
+            seen = set()
+            for doc in self._docs:
+                key = self._index_key(spec, doc)
+                if key is None:
+                    continue
+                if key in seen:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.name} index: {index_name}",
+                        code=11000,
+                    )
+                seen.add(key)
+        self._indexes[index_name] = spec
+        return index_name
+
+    async def drop_index(self, name: str):
+        self._indexes.pop(name, None)
+
+    def _index_key(self, spec: dict, doc: dict):
+        if spec["partial"] and not match(doc, spec["partial"]):
+            return None
+        return tuple(repr(get_value(doc, field)) for field in spec["fields"])
+
+    def _check_unique(self, doc: dict):
+        for index_name, spec in self._indexes.items():
+            if not spec["unique"]:
+                continue
+            key = self._index_key(spec, doc)
+            if key is None:
+                continue
+            for other in self._docs:
+                if other is not doc and self._index_key(spec, other) == key:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.name} index: {index_name}",
+                        code=11000,
+                    )
+
+    def _expire(self):
+        for spec in self._indexes.values():
+            if spec["ttl"] is None:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=spec["ttl"])
+            field = spec["fields"][0]
+            self._docs = [
+                d for d in self._docs
+                if not (isinstance(get_value(d, field), datetime) and get_value(d, field) < cutoff)
+            ]
+
+    def _matching(self, query: Optional[dict]) -> List[dict]:
+        self._expire()
+        return [d for d in self._docs if match(d, query)]
+
+    # ----- reads -----
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None, **kwargs) -> MemoryCursor:
+        def produce():
+            return [project(copy.deepcopy(d), projection) for d in self._matching(query)]
+
+        cursor = MemoryCursor(produce)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        return cursor
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        docs = await self.find(query, projection, **kwargs).to_list(1)
+        return docs[0] if docs else None
+
+    async def count_documents(self, query: Optional[dict] = None, **kwargs) -> int:
+        return len(self._matching(query))
+
+    async def estimated_document_count(self) -> int:
+        return len(self._docs)
+
+    async def distinct(self, key: str, query: Optional[dict] = None) -> list:
+        values = []
+        for doc in self._matching(query):
+            for value in get_values(doc, key):
+                for item in value if isinstance(value, list) else [value]:
+                    if item not in values:
+                        values.append(item)
+        return values
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> MemoryCursor:
+        return MemoryCursor(lambda: run_pipeline(self._storage, copy.deepcopy(self._matching(None)), pipeline))
+
+    # ----- writes -----
+
+    def _insert(self, document: dict) -> dict:
+        doc = copy.deepcopy(document)
+        doc.setdefault("_id", ObjectId())
+        self._check_unique(doc)
+        self._docs.append(doc)
+        # Motor adds _id to the caller's document as well
+        document.setdefault("_id", doc["_id"])
+        return doc
+
+    async def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        self._expire()
+        doc = self._insert(document)
+        return InsertOneResult(doc["_id"], True)
+
+    async def insert_many(self, documents: List[dict], **kwargs):
+        for document in documents:
+            await self.insert_one(document)
+
+    def _update(self, query: dict, update: dict, upsert: bool, multi: bool,
+                array_filters: Optional[List[dict]] = None) -> dict:
+        matched = self._matching(query)
+        if not multi:
+            matched = matched[:1]
+        modified = 0
+        for doc in matched:
+            before = copy.deepcopy(doc)
+            apply_update(doc, update, array_filters=array_filters)
+            if doc != before:
+                try:
+                    self._check_unique(doc)
+                except DuplicateKeyError:
+                    doc.clear()
+                    doc.update(before)
+                    raise
+                modified += 1
+        result = {"n": len(matched), "nModified": modified}
+        if not matched and upsert:
+            doc = _upsert_seed(query)
+            apply_update(doc, update, inserting=True)
+            doc = self._insert(doc)
+            result = {"n": 1, "nModified": 0, "upserted": doc["_id"]}
+        return result
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False,
+                         array_filters: Optional[List[dict]] = None, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(query, update, upsert, multi=False, array_filters=array_filters), True)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False,
+                          array_filters: Optional[List[dict]] = None, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(query, update, upsert, multi=True, array_filters=array_filters), True)
+
+    async def replace_one(self, query: dict, replacement: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(query, replacement, upsert, multi=False), True)
+
+    def _delete(self, query: dict, multi: bool) -> int:
+        matched = self._matching(query)
+        if not multi:
+            matched = matched[:1]
+        ids = {id(d) for d in matched}
+        self._docs = [d for d in self._docs if id(d) not in ids]
+        return len(matched)
+
+    async def delete_one(self, query: dict, **kwargs) -> DeleteResult:
+        return DeleteResult({"n": self._delete(query, multi=False)}, True)
+
+    async def delete_many(self, query: dict, **kwargs) -> DeleteResult:
+        return DeleteResult({"n": self._delete(query, multi=True)}, True)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None,
+                                  sort=None, upsert: bool = False,
+                                  return_document: bool = ReturnDocument.BEFORE,
+                                  array_filters: Optional[List[dict]] = None, **kwargs):
+        matched = self._matching(query)
+        if sort:
+            matched = sort_documents(matched, sort)
+        if matched:
+            doc = matched[0]
+            before = copy.deepcopy(doc)
+            apply_update(doc, update, array_filters=array_filters)
+            try:
+                self._check_unique(doc)
+            except DuplicateKeyError:
+                doc.clear()
+                doc.update(before)
+                raise
+            result = copy.deepcopy(doc) if return_document == ReturnDocument.AFTER else before
+            return project(result, projection)
+        if not upsert:
+            return None
+        doc = _upsert_seed(query)
+        apply_update(doc, update, inserting=True)
+        doc = self._insert(doc)
+        return project(copy.deepcopy(doc), projection) if return_document == ReturnDocument.AFTER else None
+
+    async def find_one_and_delete(self, query: dict, projection: Optional[dict] = None, **kwargs):
+        matched = self._matching(query)
+        if not matched:
+            return None
+        doc = matched[0]
+        self._docs = [d for d in self._docs if d is not doc]
+        return project(doc, projection)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        totals = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        for index, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                self._insert(request._doc)
+                totals["nInserted"] += 1
+                continue
+            if isinstance(request, (DeleteOne, DeleteMany)):
+                totals["nRemoved"] += self._delete(request._filter, multi=isinstance(request, DeleteMany))
+                continue
+            if isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                result = self._update(
+                    request._filter, request._doc, request._upsert, multi=isinstance(request, UpdateMany),
+                    array_filters=getattr(request, "_array_filters", None),
+                )
+                if "upserted" in result:
+                    totals["nUpserted"] += 1
+                    totals["upserted"].append({"index": index, "_id": result["upserted"]})
+                else:
+                    totals["nMatched"] += result["n"]
+                    totals["nModified"] += result["nModified"]
+                continue
+            raise OperationFailure(f"Unsupported bulk operation {type(request).__name__}")
+        return BulkWriteResult(totals, True)
+
+    async def drop(self):
+        self._docs = []
+        self._indexes = {}
+
+
+# ===================== AGGREGATION =====================
+
+def _accumulate(op: str, expr, docs: List[dict]):
+    values = [evaluate(expr, d) for d in docs]
+    if op == "$sum":
+        return sum(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool))
+    if op == "$avg":
+        numbers = [v for v in values if isinstance(v, (int, float))]
+        return sum(numbers) / len(numbers) if numbers else None
+    if op == "$min":
+        present = [v for v in values if v is not None]
+        return min(present) if present else None
+    if op == "$max":
+        present = [v for v in values if v is not None]
+        return max(present) if present else None
+    if op == "$first":
+        return values[0] if values else None
+    if op == "$last":
+        return values[-1] if values else None
+    if op == "$push":
+        return values
+    if op == "$addToSet":
+        unique = []
+        for v in values:
+            if v not in unique:
+                unique.append(v)
+        return unique
+    raise OperationFailure(f"Unsupported accumulator {op}")
+
+
+def _group(docs: List[dict], spec: dict) -> List[dict]:
+    groups: Dict[Any, List[dict]] = {}
+    keys: Dict[Any, Any] = {}
+    for doc in docs:
+        key = evaluate(spec["_id"], doc)
+        marker = repr(key)
+        groups.setdefault(marker, []).append(doc)
+        keys[marker] = key
+    results = []
+    for marker, members in groups.items():
+        row = {"_id": keys[marker]}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            op, expr = next(iter(accumulator.items()))
+            row[field] = _accumulate(op, expr, members)
+        results.append(row)
+    return results
+
+
+def _project_stage(doc: dict, spec: dict) -> dict:
+    if any(not isinstance(v, (bool, int)) for v in spec.values()):
+        result = {}
+        if spec.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for field, value in spec.items():
+            if field == "_id" and not value:
+                continue
+            if value is True or value == 1:
+                if field in doc:
+                    result[field] = doc[field]
+            elif not (value is False or value == 0):
+                result[field] = evaluate(value, doc)
+        return result
+    return project(doc, spec)
+
+
+def run_pipeline(storage: MemoryStorage, docs: List[dict], pipeline: List[dict]) -> List[dict]:
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            docs = [d for d in docs if match(d, spec)]
+        elif name == "$group":
+            docs = _group(docs, spec)
+        elif name == "$sort":
+            docs = sort_documents(docs, spec)
+        elif name == "$skip":
+            docs = docs[spec:]
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [_project_stage(d, spec) for d in docs]
+        elif name in ("$addFields", "$set"):
+            for d in docs:
+                for field, expr in spec.items():
+                    _set_path(d, field, evaluate(expr, d))
+        elif name == "$unset":
+            fields = [spec] if isinstance(spec, str) else spec
+            for d in docs:
+                for field in fields:
+                    _unset_path(d, field)
+        elif name == "$count":
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == "$unwind":
+            path = spec if isinstance(spec, str) else spec["path"]
+            field = path[1:]
+            unwound = []
+            for d in docs:
+                for item in get_value(d, field) or []:
+                    copy_doc = copy.deepcopy(d)
+                    _set_path(copy_doc, field, item)
+                    unwound.append(copy_doc)
+            docs = unwound
+        elif name == "$lookup":
+            foreign = storage[spec["from"]]._matching(None)
+            for d in docs:
+                local_values = get_values(d, spec["localField"])
+                local_values = _expand(local_values) or [None]
+                d[spec["as"]] = [
+                    copy.deepcopy(f) for f in foreign
+                    if any(_equals(get_values(f, spec["foreignField"]), v) for v in local_values)
+                ]
+        elif name == "$facet":
+            docs = [{
+                field: run_pipeline(storage, copy.deepcopy(docs), sub_pipeline)
+                for field, sub_pipeline in spec.items()
+            }]
+        else:
+            raise OperationFailure(f"Unsupported aggregation stage {name}")
+    return docs
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import {
   View,
   Text,
@@ -41,11 +41,17 @@ export default function OrderFormScreen() {
   const [user, setUser] = useState<User | null>(null);
   const [loading, setLoading] = useState(true);
   const [submitting, setSubmitting] = useState(false);
+  // Один ключ на спробу оформлення, щоб повтор не створив дубль замовлення
+  const idempotencyKey = useRef<string | null>(null);
 
   useEffect(() => {
     loadUser();
   }, []);
 
+  useEffect(() => {
+    idempotencyKey.current = null;
+  }, [items]);
+
   const loadUser = async () => {
     try {
       const userId = await AsyncStorage.getItem('user_id');
@@ -90,7 +96,12 @@ export default function OrderFormScreen() {
         discount_percent: user.discount_percent,
       };
 
-      const response = await axios.post(`${API_URL}/api/orders`, orderData);
+      if (!idempotencyKey.current) {
+        idempotencyKey.current = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+      }
+      const response = await axios.post(`${API_URL}/api/orders`, orderData, {
+        headers: { 'Idempotency-Key': idempotencyKey.current },
+      });
 
       // Очистити кошик
       clearCart();
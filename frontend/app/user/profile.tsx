@@ -28,29 +28,29 @@ const COLORS = {
   danger: '#FF6B6B',
 };
 
-interface User {
+interface Order {
   id: string;
+  total_amount: number;
+  status: string;
+  created_at: string;
+}
+
+interface UserSummary {
+  user_id: string;
   phone: string;
   full_name: string;
-  registration_date: string;
   total_orders_count: number;
   total_orders_amount: number;
   bonus_points: number;
   discount_percent: number;
   qr_md5: string;
-}
-
-interface Order {
-  id: string;
-  total_amount: number;
-  status: string;
-  created_at: string;
+  recent_orders: Order[];
 }
 
 export default function ProfileScreen() {
   const router = useRouter();
   const { setUserId } = useCartStore();
-  const [user, setUser] = useState<User | null>(null);
+  const [user, setUser] = useState<UserSummary | null>(null);
   const [orders, setOrders] = useState<Order[]>([]);
   const [loading, setLoading] = useState(true);
   const [showQR, setShowQR] = useState(false);
@@ -67,14 +67,11 @@ export default function ProfileScreen() {
         return;
       }
 
-      const [userRes, ordersRes] = await Promise.all([
-        axios.get(`${API_URL}/api/users/${userId}`),
-        axios.get(`${API_URL}/api/orders?user_id=${userId}`),
-      ]);
+      // Одне звернення: статистика та останні замовлення вже зібрані на сервері
+      const response = await axios.get(`${API_URL}/api/users/${userId}/summary`);
 
-      setUser(userRes.data);
-      await AsyncStorage.setItem('user_data', JSON.stringify(userRes.data));
-      setOrders(ordersRes.data.slice(0, 5));
+      setUser(response.data);
+      setOrders(response.data.recent_orders);
     } catch (error) {
       console.error('Failed to load profile:', error);
     } finally {
@@ -0,0 +1,303 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import DuplicateKeyError
+
+import server
+from storage import MemoryStorage
+
+
+@pytest.fixture
+def client():
+    app = server.create_app(server.AppConfig(storage="memory", background_jobs=False))
+    with TestClient(app) as c:
+        c.post("/api/seed")
+        yield c
+
+
+def register(client, phone="0501112233"):
+    response = client.post("/api/users/login", json={"phone": phone, "full_name": "Test"})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_listings_are_served_with_etag(client):
+    catalogs = client.get("/api/catalogs")
+    assert catalogs.status_code == 200 and catalogs.json()
+    etag = catalogs.headers["etag"]
+    assert client.get("/api/catalogs", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/api/catalogs", json={"name": "New", "is_product": True})
+    refreshed = client.get("/api/catalogs", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert len(refreshed.json()) == len(catalogs.json()) + 1
+
+
+def test_service_writes_refresh_the_cached_listing(client):
+    services = client.get("/api/services").json()
+    service = services[0]
+    created = client.post("/api/services", json={
+        "catalog_id": service["catalog_id"], "name": "New", "description": "", "price_uah": 500
+    }).json()
+    assert len(client.get("/api/services").json()) == len(services) + 1
+
+    client.post("/api/admin/services/bulk-update", json={"filter": {"ids": [created["id"]]}, "price_change_percent": -10})
+    prices = {s["id"]: s["price_uah"] for s in client.get("/api/services").json()}
+    assert prices[created["id"]] == 450
+
+    client.put(f"/api/services/{created['id']}", json={"name": "Renamed"})
+    names = {s["id"]: s["name"] for s in client.get("/api/services").json()}
+    assert names[created["id"]] == "Renamed"
+
+    client.delete(f"/api/services/{created['id']}")
+    assert len(client.get("/api/services").json()) == len(services)
+
+
+def test_listing_cache_ignores_unknown_parameters(client):
+    middleware = client.app.middleware_stack
+    while not isinstance(middleware, server.CompressionMiddleware):
+        middleware = middleware.app
+    for junk in range(5):
+        assert client.get("/api/catalogs", params={"visible_only": "true", "x": junk}).status_code == 200
+    assert len(middleware.cache._data) == 1
+
+
+def test_login_normalizes_phone_variants(client):
+    user = register(client, "0501112233")
+    assert user["phone"] == "+380501112233"
+    assert register(client, "380 50 111 22 33")["id"] == user["id"]
+    assert client.get("/api/users/phone/+380501112233").json()["id"] == user["id"]
+
+
+def test_order_with_idempotency_key_is_created_once(client):
+    user = register(client)
+    order = {"user_id": user["id"], "items": [], "total_amount": 100, "discount_percent": 0}
+    headers = {"Idempotency-Key": "checkout-1"}
+    first = client.post("/api/orders", json=order, headers=headers)
+    retry = client.post("/api/orders", json=order, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert first.json()["id"] == retry.json()["id"]
+
+    changed = client.post("/api/orders", json={**order, "total_amount": 5}, headers=headers)
+    assert changed.status_code == 422
+
+    summary = client.get(f"/api/users/{user['id']}/summary").json()
+    assert summary["total_orders_count"] == 1
+    assert [o["id"] for o in summary["recent_orders"]] == [first.json()["id"]]
+
+
+def test_stalled_submission_and_its_retry_create_one_order():
+    storage = MemoryStorage()
+    app = server.create_app(server.AppConfig(storage="memory", background_jobs=False), storage)
+    with TestClient(app) as client:
+        user = register(client)
+        order = {"user_id": user["id"], "items": [], "total_amount": 100, "discount_percent": 0}
+        stalled_at = datetime.utcnow() - timedelta(seconds=server.IDEMPOTENCY_WAIT_SECONDS + 1)
+        asyncio.run(storage.idempotency_keys.insert_one({
+            "user_id": user["id"], "key": "checkout-1",
+            "request_hash": server.order_request_hash(server.OrderCreate(**order)),
+            "order_id": "first", "state": "pending", "claimed_at": stalled_at, "created_at": stalled_at,
+        }))
+
+        retry = client.post("/api/orders", json=order, headers={"Idempotency-Key": "checkout-1"})
+        assert retry.status_code == 200 and retry.json()["id"] == "first"
+        # The stalled submission finishing late cannot write a second order
+        with pytest.raises(DuplicateKeyError):
+            asyncio.run(storage.orders.insert_one({"id": "first", "user_id": user["id"]}))
+        assert client.get(f"/api/users/{user['id']}/summary").json()["total_orders_count"] == 1
+
+
+def test_cart_add_creates_and_updates_one_cart(client):
+    user = register(client)
+    product = client.get("/api/products").json()[0]
+    item = {"type": "product", "item_id": product["id"], "name": product["name"],
+            "price": product["price_uah"], "quantity": 1}
+    assert client.post(f"/api/cart/{user['id']}/items", json=item).status_code == 200
+    assert client.post(f"/api/cart/{user['id']}/items", json=item).status_code == 200
+    cart = client.get(f"/api/cart/{user['id']}").json()
+    assert [i["quantity"] for i in cart["items"]] == [2]
+
+
+def test_app_instances_do_not_share_state():
+    first = server.create_app(server.AppConfig(storage="memory", background_jobs=False))
+    second = server.create_app(server.AppConfig(storage="memory", background_jobs=False))
+    with TestClient(first) as a, TestClient(second) as b:
+        a.post("/api/catalogs", json={"name": "Only in first", "is_product": True})
+        assert [c["name"] for c in a.get("/api/catalogs").json()] == ["Only in first"]
+        assert b.get("/api/catalogs").json() == []
+
+
+def test_duplicate_phones_are_merged_once_on_startup():
+    storage = MemoryStorage()
+    registered = datetime(2024, 1, 1)
+
+    async def seed():
+        await storage.users.insert_many([
+            {"id": "old", "full_name": "Old", "phone": "0501112233", "registration_date": registered, "total_orders_count": 9},
+            {"id": "new", "full_name": "New", "phone": "+380501112233", "registration_date": registered + timedelta(days=1)},
+        ])
+        await storage.orders.insert_many([
+            {"id": "o1", "user_id": "old", "status": "completed", "total_amount": 50, "bonus_points_earned": 2},
+            {"id": "o2", "user_id": "new", "status": "pending", "total_amount": 100, "bonus_points_earned": 5},
+        ])
+
+    asyncio.run(seed())
+    for _ in range(2):
+        app = server.create_app(server.AppConfig(storage="memory", background_jobs=False), storage)
+        with TestClient(app) as c:
+            user = c.get("/api/users/phone/0501112233").json()
+            assert user["id"] == "old"
+            assert (user["total_orders_count"], user["total_orders_amount"], user["bonus_points"]) == (2, 150, 7)
+            assert c.post("/api/admin/users/merge-duplicates").json()["users_merged"] == 0
+
+
+def test_admin_phone_filter_accepts_local_formats(client):
+    user = register(client, "0501234567")
+    order = {"user_id": user["id"], "items": [], "total_amount": 100, "discount_percent": 0}
+    assert client.post("/api/orders", json=order).status_code == 200
+    for phone in ("0501234567", "050123", "3805012", "+380501234567", "50 123"):
+        orders = client.get("/api/admin/orders", params={"phone": phone}).json()
+        assert [o["user_id"] for o in orders] == [user["id"]], phone
+    assert client.get("/api/admin/orders", params={"phone": "0671234"}).json() == []
+    for phone in ("3805", "+38050", "050"):
+        assert client.get("/api/admin/orders", params={"phone": phone}).status_code == 400, phone
+
+
+def place_order(client, user, total_amount=100):
+    order = {"user_id": user["id"], "items": [], "total_amount": total_amount, "discount_percent": 0}
+    response = client.post("/api/orders", json=order)
+    assert response.status_code == 200
+    return response.json()
+
+
+def user_totals(client, user):
+    summary = client.get(f"/api/users/{user['id']}/summary").json()
+    return summary["total_orders_count"], summary["total_orders_amount"]
+
+
+def test_bulk_price_change_is_rounded(client):
+    product = client.get("/api/products").json()[0]
+    client.put(f"/api/products/{product['id']}", json={"price_uah": 33.33})
+    result = client.post("/api/admin/products/bulk-update", json={
+        "filter": {"ids": [product["id"]]}, "price_change_percent": -10
+    }).json()
+    assert result == {"matched": 1, "modified": 1}
+    assert client.get(f"/api/products/{product['id']}").json()["price_uah"] == 30.0
+
+    assert client.post("/api/admin/products/bulk-update", json={"filter": {}, "is_visible": False}).status_code == 400
+    assert client.post("/api/admin/products/bulk-update", json={
+        "filter": {"ids": [product["id"]]}, "price_uah": 10, "price_change_percent": 5
+    }).status_code == 400
+
+
+def test_bulk_order_status_only_moves_orders_in_from_statuses(client):
+    user = register(client)
+    order_ids = [place_order(client, user)["id"] for _ in range(2)]
+    untouched = client.post("/api/admin/orders/bulk-status", json={
+        "order_ids": order_ids, "status": "cancelled", "from_statuses": ["completed"]
+    }).json()
+    assert untouched["modified"] == 0
+    assert user_totals(client, user) == (2, 200)
+
+    cancelled = client.post("/api/admin/orders/bulk-status", json={
+        "order_ids": order_ids[:1], "status": "cancelled", "from_statuses": ["pending"]
+    }).json()
+    assert cancelled["modified"] == 1
+    assert user_totals(client, user) == (1, 100)
+
+
+def test_bulk_order_delete_reverses_user_stats(client):
+    user = register(client)
+    kept = place_order(client, user, 100)
+    deleted = place_order(client, user, 40)
+    assert client.post("/api/admin/orders/bulk-delete", json={"order_ids": [deleted["id"]]}).json() == {"deleted": 1}
+    summary = client.get(f"/api/users/{user['id']}/summary").json()
+    assert (summary["total_orders_count"], summary["total_orders_amount"]) == (1, 100)
+    assert [o["id"] for o in summary["recent_orders"]] == [kept["id"]]
+
+
+def test_catalog_delete_cascades_to_products_services_and_master_links(client):
+    service = client.get("/api/services").json()[0]
+    catalog_id = service["catalog_id"]
+    master = client.post("/api/masters", json={"full_name": "Master", "position": "instructor"}).json()
+    assert client.post(f"/api/masters/{master['id']}/services/{service['id']}").status_code == 200
+
+    assert client.delete(f"/api/catalogs/{catalog_id}").status_code == 200
+    for _ in range(50):
+        if not client.get(f"/api/masters/{master['id']}").json()["service_ids"]:
+            break
+        time.sleep(0.02)
+    assert client.get(f"/api/masters/{master['id']}").json()["service_ids"] == []
+    assert client.get("/api/services", params={"catalog_id": catalog_id}).json() == []
+    assert client.get("/api/products", params={"catalog_id": catalog_id}).json() == []
+    report = client.get("/api/admin/integrity").json()
+    assert report["missing_catalog_ids"] == [] and report["dangling_service_ids"] == []
+
+
+def test_integrity_repair_removes_orphans():
+    storage = MemoryStorage()
+    app = server.create_app(server.AppConfig(storage="memory", background_jobs=False), storage)
+    with TestClient(app) as client:
+        asyncio.run(storage.products.insert_one({"id": "orphan", "catalog_id": "gone"}))
+        asyncio.run(storage.masters.insert_one({"id": "m", "full_name": "M", "position": "guru", "service_ids": ["gone"]}))
+
+        report = client.get("/api/admin/integrity").json()
+        assert (report["orphan_products"], report["dangling_service_ids"], report["repaired"]) == (1, ["gone"], False)
+        assert client.get("/api/admin/integrity", params={"repair": True}).json()["repaired"] is True
+
+        report = client.get("/api/admin/integrity").json()
+        assert (report["orphan_products"], report["dangling_service_ids"]) == (0, [])
+        assert asyncio.run(storage.masters.find_one({"id": "m"}))["service_ids"] == []
+
+
+def test_service_bulk_delete_unlinks_masters(client):
+    service = client.get("/api/services").json()[0]
+    master = client.post("/api/masters", json={"full_name": "Master", "position": "instructor"}).json()
+    client.post(f"/api/masters/{master['id']}/services/{service['id']}")
+    result = client.post("/api/admin/services/bulk-delete", json={"filter": {"ids": [service["id"]]}}).json()
+    assert result["deleted"] == 1 and result["masters_updated"] >= 1
+    assert all(service["id"] not in m["service_ids"] for m in client.get("/api/masters").json())
+
+
+def test_reconcile_finds_no_drift_after_a_cancellation(client):
+    user = register(client)
+    order = place_order(client, user)
+    place_order(client, user, 50)
+    client.put(f"/api/orders/{order['id']}/status", params={"status": "cancelled"})
+    report = client.post("/api/admin/users/reconcile-stats").json()
+    assert report["users_corrected"] == 0
+    assert report["drift"] == {"total_orders_count": 0, "total_orders_amount": 0, "bonus_points": 0}
+    assert user_totals(client, user) == (1, 50)
+
+
+def test_reconcile_corrects_drift_unless_an_order_lands_first():
+    storage = MemoryStorage()
+    app = server.create_app(server.AppConfig(storage="memory", background_jobs=False), storage)
+    with TestClient(app) as client:
+        user = register(client)
+        place_order(client, user)
+        asyncio.run(storage.users.update_one({"id": user["id"]}, {"$set": {"total_orders_amount": 999}}))
+
+        dry_run = client.post("/api/admin/users/reconcile-stats", params={"dry_run": True}).json()
+        assert dry_run["users_corrected"] == 1 and dry_run["drift"]["total_orders_amount"] == -899
+        assert user_totals(client, user) == (1, 999)
+
+        # An order written between the read and the correction wins, the user is left for the next run
+        bulk_write = storage.users.bulk_write
+
+        async def bulk_write_after_order(requests, **kwargs):
+            await storage.users.update_one({"id": user["id"]}, {"$inc": {"total_orders_count": 1}})
+            return await bulk_write(requests, **kwargs)
+
+        storage.users.bulk_write = bulk_write_after_order
+        report = client.post("/api/admin/users/reconcile-stats").json()
+        assert (report["users_corrected"], report["users_skipped"]) == (0, 1)
+        assert user_totals(client, user) == (2, 999)
+
+        storage.users.bulk_write = bulk_write
+        report = client.post("/api/admin/users/reconcile-stats").json()
+        assert (report["users_corrected"], report["users_skipped"]) == (1, 0)
+        assert user_totals(client, user) == (1, 100)
@@ -0,0 +1,165 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo import ReturnDocument, UpdateOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from storage import MemoryStorage, Storage
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db():
+    return MemoryStorage()
+
+
+def test_storage_base_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_query_operators(db):
+    async def scenario():
+        await db.orders.insert_many([
+            {"id": "1", "status": "pending", "total_amount": 100, "items": [{"type": "product"}]},
+            {"id": "2", "status": "completed", "total_amount": 250, "items": [{"type": "service"}]},
+            {"id": "3", "status": "cancelled", "total_amount": 50, "items": []},
+        ])
+
+        async def ids(query):
+            return sorted(d["id"] for d in await db.orders.find(query).to_list(None))
+
+        assert await ids({"status": {"$in": ["pending", "completed"]}}) == ["1", "2"]
+        assert await ids({"status": {"$nin": ["cancelled"]}, "total_amount": {"$gte": 200}}) == ["2"]
+        assert await ids({"items.type": "service"}) == ["2"]
+        assert await ids({"items": {"$size": 0}}) == ["3"]
+        assert await ids({"$or": [{"id": "1"}, {"total_amount": {"$lt": 60}}]}) == ["1", "3"]
+        assert await ids({"status": {"$regex": "^PEND", "$options": "i"}}) == ["1"]
+        assert await ids({"discount": {"$exists": False}, "total_amount": {"$not": {"$gt": 100}}}) == ["1", "3"]
+        assert await ids({"$expr": {"$gt": ["$total_amount", 99]}}) == ["1", "2"]
+        assert await db.orders.count_documents({"status": {"$ne": "cancelled"}}) == 2
+
+    run(scenario())
+
+
+def test_update_operators_and_upsert(db):
+    async def scenario():
+        await db.users.insert_one({"id": "u", "total": 1, "tags": ["a"], "recent": [3, 2, 1]})
+        await db.users.update_one({"id": "u"}, {
+            "$inc": {"total": 2},
+            "$addToSet": {"tags": {"$each": ["a", "b"]}},
+            "$push": {"recent": {"$each": [4], "$position": 0, "$slice": 3}},
+        })
+        user = await db.users.find_one({"id": "u"}, {"_id": 0})
+        assert user == {"id": "u", "total": 3, "tags": ["a", "b"], "recent": [4, 3, 2]}
+
+        await db.users.update_one({"id": "u"}, {"$pull": {"tags": "a"}, "$unset": {"recent": ""}})
+        assert await db.users.find_one({"id": "u"}, {"_id": 0}) == {"id": "u", "total": 3, "tags": ["b"]}
+
+        created = await db.users.find_one_and_update(
+            {"phone": "+380501112233"},
+            {"$setOnInsert": {"id": "new"}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        assert created["phone"] == "+380501112233" and created["id"] == "new"
+        again = await db.users.find_one_and_update(
+            {"phone": "+380501112233"},
+            {"$setOnInsert": {"id": "other"}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        assert again["id"] == "new"
+
+    run(scenario())
+
+
+def test_array_filters(db):
+    async def scenario():
+        await db.users.insert_one({"id": "u", "recent_orders": [
+            {"id": "o1", "status": "pending"},
+            {"id": "o2", "status": "pending"},
+        ]})
+        await db.users.update_one(
+            {"id": "u"},
+            {"$set": {"recent_orders.$[o].status": "completed"}},
+            array_filters=[{"o.id": "o2"}],
+        )
+        user = await db.users.find_one({"id": "u"})
+        assert [o["status"] for o in user["recent_orders"]] == ["pending", "completed"]
+
+    run(scenario())
+
+
+def test_aggregate_group_and_lookup(db):
+    async def scenario():
+        await db.users.insert_many([{"id": "a", "name": "A"}, {"id": "b", "name": "B"}])
+        await db.orders.insert_many([
+            {"user_id": "a", "total_amount": 10},
+            {"user_id": "a", "total_amount": 5},
+            {"user_id": "b", "total_amount": 7},
+        ])
+        totals = await db.orders.aggregate([
+            {"$group": {"_id": "$user_id", "sum": {"$sum": "$total_amount"}, "n": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+        ]).to_list(None)
+        assert totals == [{"_id": "a", "sum": 15, "n": 2}, {"_id": "b", "sum": 7, "n": 1}]
+
+        joined = await db.users.aggregate([
+            {"$lookup": {"from": "orders", "localField": "id", "foreignField": "user_id", "as": "orders"}},
+            {"$project": {"_id": 0, "id": 1, "orders": 1}},
+            {"$sort": {"id": 1}},
+        ]).to_list(None)
+        assert [len(u["orders"]) for u in joined] == [2, 1]
+
+    run(scenario())
+
+
+def test_unique_and_partial_indexes(db):
+    async def scenario():
+        await db.users.create_index("qr_md5", unique=True, partialFilterExpression={"qr_md5": {"$gt": ""}})
+        await db.users.insert_many([{"id": "a", "qr_md5": ""}, {"id": "b", "qr_md5": ""}])
+        await db.users.insert_one({"id": "c", "qr_md5": "x"})
+        with pytest.raises(DuplicateKeyError):
+            await db.users.insert_one({"id": "d", "qr_md5": "x"})
+        with pytest.raises(DuplicateKeyError):
+            await db.users.update_one({"id": "a"}, {"$set": {"qr_md5": "x"}})
+        assert (await db.users.find_one({"id": "a"}))["qr_md5"] == ""
+
+        with pytest.raises(OperationFailure) as conflict:
+            await db.users.create_index("qr_md5", unique=False)
+        assert conflict.value.code == 85
+
+    run(scenario())
+
+
+def test_ttl_index_expires_documents(db):
+    async def scenario():
+        await db.carts.create_index("updated_at", expireAfterSeconds=3600)
+        now = datetime.utcnow()
+        await db.carts.insert_many([
+            {"user_id": "fresh", "updated_at": now},
+            {"user_id": "stale", "updated_at": now - timedelta(hours=2)},
+        ])
+        remaining = await db.carts.find({}).to_list(None)
+        assert [c["user_id"] for c in remaining] == ["fresh"]
+
+    run(scenario())
+
+
+def test_bulk_write(db):
+    async def scenario():
+        await db.masters.insert_many([{"id": str(i), "n": i} for i in range(4)])
+        result = await db.masters.bulk_write([
+            UpdateOne({"id": "0"}, {"$set": {"n": 10}}),
+            UpdateOne({"id": "missing"}, {"$set": {"n": 1}}),
+            DeleteMany({"n": {"$gte": 2, "$lt": 10}}),
+        ])
+        assert (result.matched_count, result.modified_count, result.deleted_count) == (1, 1, 2)
+        assert sorted(d["id"] for d in await db.masters.find({}).to_list(None)) == ["0", "1"]
+
+    run(scenario())